@@ -1,22 +1,66 @@
+import collections
+import itertools
+import json
 import multiprocessing as mp
 import numbers
 import numpy as np
 
 from .core import (VariableCollection, ParameterCollection, Parameter, RateFunctionCollection,
                    ReactionCollection, InputError)
-from .simulators import ssa, next_reaction_method, fluid_approximation
+from .utils.trajectory import (SharedTrajectories, TrajectoryBatch, shared_memory_available,
+                               write_shared_trajectories)
+from .simulators import (ssa, ssa_ensemble, optimized_direct_method, sorting_direct_method,
+                         composition_rejection, rejection_ssa, next_reaction_method,
+                         slow_scale_ssa, fluid_approximation, moment_equations,
+                         chemical_langevin, hybrid, tau_leaping)
 
 
-ALGORITHMS_AVAIL = ("ssa", "gillespie", "nrm", "next reaction method", "gibson bruck",
-                    "gibson-bruck", "fluid approximation", "fluid limit", "mean field",
-                    "ode", "tau-leaping")
+ALGORITHMS_AVAIL = ("ssa", "gillespie", "ssa ensemble", "ensemble ssa", "odm",
+                    "optimized direct method", "sdm", "sorting direct method",
+                    "composition rejection", "ssa-cr", "rssa", "rejection ssa",
+                    "slow-scale ssa", "ssssa", "nrm",
+                    "next reaction method", "gibson bruck", "gibson-bruck", "fluid approximation",
+                    "fluid limit", "mean field", "ode", "lna", "linear noise approximation",
+                    "moment closure", "cle", "chemical langevin", "langevin", "hybrid",
+                    "hybrid ssa/ode", "tau-leaping")
 
-global ALG_INPUT
+# Models built by the worker processes, indexed by their description; see `_worker_model`.
+_WORKER_MODELS = {}
+_WORKER_MODELS_MAX = 8
 
 
-def _dummy_function(proc_num=None):
-    func, args, secondary_args = ALG_INPUT
-    return func(*args, **secondary_args)
+def _model_key(alg_params_dict, simul_params_dict):
+    return json.dumps([alg_params_dict, simul_params_dict], sort_keys=True, default=str)
+
+
+def _worker_model(alg_params_dict, simul_params_dict):
+    """Controller built inside a worker process from the (picklable) description of the model.
+
+    Rate functions are compiled only the first time a description is seen by the worker, then the
+    controller is reused by the following tasks.
+    """
+    key = _model_key(alg_params_dict, simul_params_dict)
+    if key not in _WORKER_MODELS:
+        if len(_WORKER_MODELS) >= _WORKER_MODELS_MAX:
+            del _WORKER_MODELS[next(iter(_WORKER_MODELS))]
+        _WORKER_MODELS[key] = MainControllerCPU(alg_params_dict, simul_params_dict)
+    return _WORKER_MODELS[key]
+
+
+def _init_worker(alg_params_dict, simul_params_dict):
+    _worker_model(alg_params_dict, simul_params_dict)
+
+
+def _simulate_in_worker(task):
+    alg_params_dict, simul_params_dict, num_trajectories, seed = task
+    # Forked workers inherit the random state of the parent: each task has its own seed.
+    np.random.seed(seed)
+    return _worker_model(alg_params_dict, simul_params_dict)._run_trajectories(num_trajectories)
+
+
+def _simulate_in_worker_shared(task):
+    # Only the layout of the shared memory segment is sent back to the parent process.
+    return write_shared_trajectories(_simulate_in_worker(task))
 
 
 def boppy_setup(alg_params_dict, simul_params_dict):
@@ -81,8 +125,13 @@ class MainControllerCommon:
             self._initial_conditions[self._variables[species].pos] = initial_amount
 
         self._secondary_args = {}
+        self._setup_model()
         self._setup_alg_and_secondary_param(self._alg_chosen)
 
+    def _setup_model(self):
+        # Can be extended in the child classes to build the objects needed by the algorithms.
+        pass
+
     def _setup_alg_and_secondary_param(self, str_alg):
         # Must be implemented in the child classes.
         raise NotImplementedError
@@ -91,24 +140,59 @@ class MainControllerCommon:
         # Must be implemented in the child classes.
         raise NotImplementedError
 
+    def close(self):
+        # Can be extended in the child classes to release the resources used by the simulations.
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     @property
     def species(self):
         return self._variables
 
 
 class MainControllerCPU(MainControllerCommon):
-    """Controller for CPU-based processes."""
+    """Controller for CPU-based processes.
+
+    Trajectories are split among a pool of worker processes, owned by the controller and kept
+    alive between simulations: call `close`, or use the controller as a context manager, to stop
+    them.
+    """
 
     def __init__(self, alg_params_dict, simul_params_dict):
+        self._pool = None
+
+        start_method_label = "Process start method"
+        self._start_method = simul_params_dict.get(start_method_label)
+        if self._start_method is not None and \
+                self._start_method not in mp.get_all_start_methods():
+            raise InputError("The '{}' parameter must be one of {}.".format(
+                start_method_label, ", ".join(mp.get_all_start_methods())))
+
+        shared_memory_label = "Use shared memory"
+        self._use_shared_memory = simul_params_dict.get(shared_memory_label, False)
+        if not isinstance(self._use_shared_memory, bool):
+            raise InputError("The '{}' option must be true/false or no/yes; found "
+                             "'{}'.".format(shared_memory_label, self._use_shared_memory))
+        if self._use_shared_memory and not shared_memory_available():
+            raise InputError("The '{}' option requires Python 3.8 or "
+                             "later.".format(shared_memory_label))
+
         super(MainControllerCPU, self).__init__(alg_params_dict, simul_params_dict)
 
+    def _setup_model(self):
         # Treat the system size as a parameter, so it's substituted, e.g. in RateFunction objects.
         self._parameters = ParameterCollection(dict(self._orig_alg_dict["Parameters"],
                                                     **self._orig_alg_dict["System size"]))
         self._parameters_wo_system_size = ParameterCollection(self._orig_alg_dict["Parameters"])
 
         self._rate_functions = RateFunctionCollection(self._orig_alg_dict["Rate functions"],
-                                                      self._variables, self._parameters)
+                                                      self._variables, self._parameters,
+                                                      compiled=True)
         self._rf_var_system_size = RateFunctionCollection(self._orig_alg_dict["Rate functions"],
                                                           self._variables,
                                                           self._parameters_wo_system_size)
@@ -121,41 +205,277 @@ class MainControllerCPU(MainControllerCommon):
 
         Save into `self._secondary_args` optional arguments that are then passed to the simulator.
         """
+        self._batched_alg = False
+
         if str_alg.lower() in ("ssa", "gillespie"):
             self._selected_alg = ssa.SSA
+        elif str_alg.lower() in ("ssa ensemble", "ensemble ssa"):
+            # All the iterations are advanced together inside a single call of the simulator.
+            self._secondary_args["iterations"] = self._iterations
+            self._batched_alg = True
+            self._selected_alg = ssa_ensemble.SSA
+        elif str_alg.lower() in ("odm", "optimized direct method"):
+            self._secondary_args.update({'depends_on': self._rate_functions.depends_on,
+                                         'affects': self._reactions.affects})
+            self._selected_alg = optimized_direct_method.optimized_direct_method
+        elif str_alg.lower() in ("sdm", "sorting direct method"):
+            self._secondary_args.update({'depends_on': self._rate_functions.depends_on,
+                                         'affects': self._reactions.affects})
+            self._selected_alg = sorting_direct_method.sorting_direct_method
+        elif str_alg.lower() in ("composition rejection", "ssa-cr"):
+            self._secondary_args.update({'depends_on': self._rate_functions.depends_on,
+                                         'affects': self._reactions.affects})
+            self._selected_alg = composition_rejection.composition_rejection
+        elif str_alg.lower() in ("rssa", "rejection ssa"):
+            self._secondary_args.update({'depends_on': self._rate_functions.depends_on})
+            self._selected_alg = rejection_ssa.rejection_ssa
+        elif str_alg.lower() in ("slow-scale ssa", "ssssa"):
+            fast_ratio_label = "Slow-scale fast ratio"
+            fast_ratio = self._orig_simul_dict.get(fast_ratio_label, 100)
+            if not isinstance(fast_ratio, numbers.Number) or fast_ratio <= 0:
+                raise InputError("The '{}' parameter has to be a positive "
+                                 "number.".format(fast_ratio_label))
+            self._secondary_args.update({'depends_on': self._rate_functions.depends_on,
+                                         'fast_ratio': fast_ratio})
+            self._selected_alg = slow_scale_ssa.slow_scale_ssa
         elif str_alg.lower() in ("nrm", "next reaction method", "gibson bruck", "gibson-bruck"):
-            self._secondary_args.update({'depends_on': self._reactions.depends_on,
+            self._secondary_args.update({'depends_on': self._rate_functions.depends_on,
                                          'affects': self._reactions.affects})
             self._selected_alg = next_reaction_method.next_reaction_method
         elif str_alg.lower() in ("fluid approximation", "fluid limit", "mean field", "ode"):
             self._secondary_args.update(
                 {'rate_functions_var_ss': self._rf_var_system_size,
                  'variables': self._variables,
-                 'system_size': self._system_size.value})
+                 'system_size': self._system_size,
+                 'ode_solver': self._ode_solver_option()})
             self._selected_alg = fluid_approximation.fluid_approximation
 
+            parameters_sets = self._parameter_sweep_option()
+            if parameters_sets is not None:
+                # All the parameters sets are integrated together, split among the processes.
+                self._secondary_args.update({'parameters': self._parameters_wo_system_size,
+                                             'parameters_sets': parameters_sets,
+                                             'processes': self._nproc})
+                self._batched_alg = True
+                self._selected_alg = fluid_approximation.fluid_approximation_sweep
+        elif str_alg.lower() in ("lna", "linear noise approximation"):
+            self._secondary_args.update({'variables': self._variables,
+                                         'ode_solver': self._ode_solver_option()})
+            self._selected_alg = moment_equations.linear_noise_approximation
+        elif str_alg.lower() == "moment closure":
+            self._secondary_args.update({'variables': self._variables,
+                                         'ode_solver': self._ode_solver_option()})
+            self._selected_alg = moment_equations.moment_closure
+        elif str_alg.lower() in ("cle", "chemical langevin", "langevin"):
+            time_step_label, boundary_label = "CLE time step", "CLE boundary"
+            time_step = self._orig_simul_dict.get(time_step_label)
+            if time_step is not None and (not isinstance(time_step, numbers.Number) or
+                                          time_step <= 0):
+                raise InputError("The '{}' parameter has to be a positive "
+                                 "number.".format(time_step_label))
+            boundary = self._orig_simul_dict.get(boundary_label, "truncate")
+            if boundary not in chemical_langevin.BOUNDARIES_AVAIL:
+                raise InputError("The '{}' parameter must be one of {}.".format(
+                    boundary_label, ", ".join(chemical_langevin.BOUNDARIES_AVAIL)))
+
+            # All the iterations are advanced together inside a single call of the simulator.
+            self._secondary_args.update({'iterations': self._iterations,
+                                         'time_step': time_step,
+                                         'boundary': boundary})
+            self._batched_alg = True
+            self._selected_alg = chemical_langevin.chemical_langevin
+        elif str_alg.lower() in ("hybrid", "hybrid ssa/ode"):
+            self._secondary_args.update({'fast_reactions': self._fast_reactions_option(),
+                                         'ode_solver': self._ode_solver_option()})
+            for label, arg in (("Hybrid rate threshold", 'rate_threshold'),
+                               ("Hybrid population threshold", 'population_threshold')):
+                threshold = self._orig_simul_dict.get(label)
+                if threshold is None:
+                    continue
+                if not isinstance(threshold, numbers.Number) or threshold < 0:
+                    raise InputError("The '{}' parameter has to be a non negative "
+                                     "number.".format(label))
+                self._secondary_args[arg] = threshold
+            self._selected_alg = hybrid.hybrid_ssa_ode
+        elif str_alg.lower() == "tau-leaping":
+            epsilon_label = "Tau-leaping epsilon"
+            epsilon = self._orig_simul_dict.get(epsilon_label, 0.03)
+            if not isinstance(epsilon, numbers.Number) or not 0 < epsilon < 1:
+                raise InputError("The '{}' parameter has to be a number between 0 and "
+                                 "1.".format(epsilon_label))
+            self._secondary_args.update({'reagents': self._reactions.reagents_matrix,
+                                         'epsilon': epsilon})
+            self._selected_alg = tau_leaping.tau_leaping
+
         else:
             raise NotImplementedError("The chosen algorithm '{}' has not been "
                                       "implemented yet.".format(str_alg))
 
-    def simulate(self):
-        # Using a global variable is dirty: the preferred way would be to use a mp.starmap, and
-        # pass it the ALG_INPUT parameters; this doesn't work because inside _rate_functions there
-        # are lambda functions, which cannot be pickled to be transferred to the other processes.
-        # This (should) work safely because ALG_INPUT is only read by processes, but not written.
-        global ALG_INPUT
+    def _ode_solver_option(self):
+        ode_solver_label = "ODE solver"
+        ode_solver = self._orig_simul_dict.get(ode_solver_label)
+        if ode_solver is not None and ode_solver not in fluid_approximation.ODE_SOLVERS_AVAIL:
+            raise InputError("The '{}' parameter must be one of {}.".format(
+                ode_solver_label, ", ".join(fluid_approximation.ODE_SOLVERS_AVAIL)))
+        return ode_solver
+
+    def _parameter_sweep_option(self):
+        """List of parameters sets, from the lists of values of each parameter to explore."""
+        sweep_label = "Parameter sweep"
+        sweep = self._orig_simul_dict.get(sweep_label)
+        if sweep is None:
+            return None
+
+        if not isinstance(sweep, dict) or not sweep:
+            raise InputError("The '{}' parameter must map parameters to lists of "
+                             "values.".format(sweep_label))
+        for param, values in sweep.items():
+            if param not in self._orig_alg_dict["Parameters"]:
+                raise InputError("The parameter '{}' in '{}' does not match any parameter "
+                                 "provided.".format(param, sweep_label))
+            if not isinstance(values, list) or \
+                    not all(isinstance(value, numbers.Number) for value in values):
+                raise InputError("The values of '{}' in '{}' must be a list of "
+                                 "numbers.".format(param, sweep_label))
+        if len(set(len(values) for values in sweep.values())) != 1:
+            raise InputError("All the parameters in '{}' must have the same number of "
+                             "values.".format(sweep_label))
+
+        return [dict(zip(sweep, values)) for values in zip(*sweep.values())]
+
+    def _fast_reactions_option(self):
+        """Indices of the reactions listed by the user as fast, or None to partition dynamically."""
+        fast_reactions_label = "Fast reactions"
+        fast_reactions = self._orig_simul_dict.get(fast_reactions_label)
+        if fast_reactions is None:
+            return None
+
+        # Reactions are matched regardless of the spacing used.
+        reactions = [" ".join(reaction.split()) for reaction in self._orig_alg_dict["Reactions"]]
+        indices = []
+        for reaction in fast_reactions:
+            normalized = " ".join(str(reaction).split())
+            if normalized not in reactions:
+                raise InputError("The reaction '{}' in '{}' does not match any reaction "
+                                 "provided.".format(reaction, fast_reactions_label))
+            indices.append(reactions.index(normalized))
+        return indices
+
+    def update_parameters(self, parameters_values):
+        """Change the values of some Parameters, and rebuild the model.
+
+        The worker processes already started are reused: they build the new model the first time
+        they receive a task for it.
+        """
+        unknown = set(parameters_values) - set(self._orig_alg_dict["Parameters"])
+        if unknown:
+            raise InputError("The parameters {} do not match any parameter "
+                             "provided.".format(", ".join(sorted(unknown))))
+
+        self._orig_alg_dict = dict(self._orig_alg_dict,
+                                   Parameters=dict(self._orig_alg_dict["Parameters"],
+                                                   **parameters_values))
+        self._secondary_args = {}
+        self._setup_model()
+        self._setup_alg_and_secondary_param(self._alg_chosen)
 
-        ALG_INPUT = (self._selected_alg, (self.update_matrix, self._initial_conditions,
-                                          self._rate_functions, self._t_max),
-                     self._secondary_args)
+    def _run_trajectories(self, num_trajectories):
+        return [self._selected_alg(self.update_matrix, self._initial_conditions,
+                                   self._rate_functions, self._t_max, **self._secondary_args)
+                for _ in range(num_trajectories)]
 
-        with mp.Pool(processes=self._nproc) as pool:
-            populations_and_times = pool.map(_dummy_function, range(self._iterations))
+    def _get_pool(self):
+        """Pool of worker processes, started the first time it's needed and then kept alive.
+
+        Workers don't receive the compiled rate functions, which cannot be pickled: each one builds
+        the model in the pool initializer, from the input dictionaries.
+        """
+        if self._pool is None:
+            context = mp.get_context(self._start_method)
+            self._pool = context.Pool(processes=self._nproc, initializer=_init_worker,
+                                      initargs=(self._orig_alg_dict, self._orig_simul_dict))
+        return self._pool
+
+    def close(self):
+        """Stop the worker processes, if any; a new pool is started by the next simulation."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _tasks(self, batch_size):
+        """Tasks for the workers, each one computing up to `batch_size` trajectories.
+
+        The seed of each task is drawn from the random state of this process, so that the
+        simulations are reproducible by seeding it, whichever worker runs the task.
+        """
+        num_batches, remainder = divmod(self._iterations, batch_size)
+        sizes = [batch_size] * num_batches + ([remainder] if remainder else [])
+        seeds = np.random.randint(2 ** 31 - 1, size=len(sizes))
+        return [(self._orig_alg_dict, self._orig_simul_dict, size, seed)
+                for size, seed in zip(sizes, seeds.tolist())]
+
+    def simulate_iter(self, batch_size=None, max_outstanding=None):
+        """Yield the trajectories as soon as they're computed, instead of returning all of them.
+
+        Each task sent to the workers computes `batch_size` trajectories, by default a quarter of
+        the ones for each process. At most `max_outstanding` tasks, by default two for each
+        process, are submitted to the pool and not yielded yet: a new one is submitted only when
+        the oldest one is consumed, so the parent process holds a bounded number of batches even
+        when the consumer is slower than the workers. Batches are yielded in submission order.
+        """
+        if self._batched_alg:
+            yield from self.simulate()
+            return
+
+        if batch_size is None:
+            batch_size = max(1, self._iterations // (4 * self._nproc))
+        if max_outstanding is None:
+            max_outstanding = 2 * self._nproc
+
+        pool = self._get_pool()
+        tasks = iter(self._tasks(batch_size))
+        pending = collections.deque(pool.apply_async(_simulate_in_worker, (task,))
+                                    for task in itertools.islice(tasks, max_outstanding))
+        while pending:
+            trajectories = pending.popleft().get()
+            # Refill the window before yielding, so that the workers don't wait for the consumer.
+            for task in itertools.islice(tasks, 1):
+                pending.append(pool.apply_async(_simulate_in_worker, (task,)))
+            yield from trajectories
+
+    def simulate(self):
+        """Run the simulations; return the trajectories as a TrajectoryBatch.
+
+        With the shared memory option, a SharedTrajectories object with the views over the
+        segments written by the workers is returned instead: it has the interface of a
+        TrajectoryBatch, except for `data`, since the trajectories are spread over one segment for
+        each worker, and it has to be closed to release the memory. Its `to_batch` method copies
+        the trajectories into a TrajectoryBatch.
+        """
+        if self._batched_alg:
+            results = self._selected_alg(self.update_matrix, self._initial_conditions,
+                                         self._rate_functions, self._t_max,
+                                         **self._secondary_args)
+            if isinstance(results, np.ndarray):
+                # A (trajectories x times x columns) array, e.g. from the parameter sweep.
+                return TrajectoryBatch.from_dense(results)
+            return TrajectoryBatch.from_list(results)
+
+        if self._use_shared_memory:
+            # Each worker writes its trajectories in a single segment, which is mapped here.
+            batch_size = -(-self._iterations // self._nproc)
+            return SharedTrajectories(self._get_pool().map(_simulate_in_worker_shared,
+                                                           self._tasks(batch_size)))
+
+        populations_and_times = [trajectory for trajectories in
+                                 self._get_pool().map(_simulate_in_worker, self._tasks(1))
+                                 for trajectory in trajectories]
 
         # The output from the map is a list of numpy 2D arrays; they are the result of stochastic
         # processes and their content is variable; the pairs can have different lengths, so we
-        # cannot pack them into a multidimensional array.
-        return populations_and_times
+        # cannot pack them into a multidimensional array, but we concatenate them in a batch.
+        return TrajectoryBatch.from_list(populations_and_times)
 
 
 class MainControllerGPU(MainControllerCommon):
@@ -193,5 +513,10 @@ class MainControllerGPU(MainControllerCommon):
                                       "implemented yet.".format(str_alg))
 
     def simulate(self):
-        return self._selected_alg(self.update_matrix, self._initial_conditions,
-                                  self._rate_functions, self._t_max, **self._secondary_args)
+        time_states_dev = self._selected_alg(self.update_matrix, self._initial_conditions,
+                                             self._rate_functions, self._t_max,
+                                             **self._secondary_args)
+        # The device array has a (iterations x steps x (1 + species)) layout; the kernel stops
+        # writing a trajectory after its first time >= t_max, and the (uninitialized) rows
+        # following it are dropped.
+        return TrajectoryBatch.from_dense(time_states_dev.get(), end_time=self._t_max)
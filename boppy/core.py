@@ -1,8 +1,9 @@
-from collections import defaultdict
 import itertools
 import logging
 import numpy as np
+from scipy import sparse
 import sympy as sym
+from sympy.printing.lambdarepr import NumPyPrinter
 
 from .utils import parser, misc
 
@@ -105,6 +106,8 @@ class RateFunction:
 
         # Convert back each Parameter object to {sympy object: actual value}
         # and substitute it.
+        # The function before the substitution is kept, e.g. to derive it w.r.t. the Parameters.
+        self.sym_function_with_params = function_with_params
         param_symbol_to_val = {
             val.symbol: val.value for val in parameters_collection.values()}
         self.sym_function = function_with_params.subs(param_symbol_to_val)
@@ -112,7 +115,14 @@ class RateFunction:
             "Substituted Parameters with their value; function '%s':", self.sym_function)
 
         self.lambdified = sym.lambdify(tuple(var.symbol for var in variables_collection.values()),
-                                       self.sym_function)
+                                       self.sym_function,
+                                       modules=[{"numpy": np}, "numpy"],
+                                       printer=_ElementwiseNumPyPrinter)
+
+        # Positions of the species the rate depends on, which can be more than the reagents.
+        self.depends_on_vector = np.array(sorted(var.pos for var in variables_collection.values()
+                                                 if var.symbol in self.sym_function.free_symbols),
+                                          dtype=int)
 
     def function(self, arg):
         return self.lambdified(*arg)
@@ -135,11 +145,12 @@ class Reaction:
         self._orig_reaction = str_reaction
         self._variables = variables_collection
 
-        self._dict_reaction = self.update_vector = None
+        self._dict_reaction = self.update_vector = self.reagents_vector = None
         self.affects_vector = self.depends_on_vector = None
 
         self._parse_reaction()
         self._produce_update_vector()
+        self._produce_reagents_vector()
         self._depends_on()
         self._affects()
 
@@ -168,6 +179,17 @@ class Reaction:
             var = self._extract_variable_from_input_list(symbol)
             self.update_vector[var.pos] += quantity
 
+    def _produce_reagents_vector(self):
+        """Vector with the (positive) number of molecules of each species consumed as reagent.
+
+        The sum of its elements is the order of the reaction.
+        """
+        self.reagents_vector = np.zeros(len(self._variables), dtype=float)
+
+        for symbol, quantity in self._dict_reaction["reagents"]:
+            var = self._extract_variable_from_input_list(symbol)
+            self.reagents_vector[var.pos] -= quantity
+
     def __str__(self):
         return self.__class__.__name__ + "(" + repr(self._orig_reaction) + ")"
 
@@ -235,27 +257,140 @@ class ParameterCollection(CommonProxyMethods):
                      for str_param, value in dict_parameters.items()}
 
 
+class _ElementwiseNumPyPrinter(NumPyPrinter):
+    """NumPy printer that keeps Max/Min element-wise, so that the generated code also works on
+    arrays of states, and not only on scalars.
+
+    The code printed refers to the `numpy` module, which has to be in the namespace where it's
+    evaluated, together with the names of `_numpy_namespace`.
+    """
+
+    def _print_nested_binary(self, func, args):
+        """Nest the binary ufunc, e.g. `maximum(a, maximum(b, c))`, so that the arguments broadcast
+        even when some of them are constants and others are arrays.
+        """
+        printed = [self._print(arg) for arg in args]
+        nested = printed[-1]
+        for arg in reversed(printed[:-1]):
+            nested = "{}({}, {})".format(func, arg, nested)
+        return nested
+
+    def _print_Max(self, expr):
+        return self._print_nested_binary("numpy.maximum", expr.args)
+
+    def _print_Min(self, expr):
+        return self._print_nested_binary("numpy.minimum", expr.args)
+
+
+def _numpy_namespace():
+    """Namespace for the code generated by the NumPy printers of sympy.
+
+    Older sympy versions print bare function names (e.g. `exp`, `Abs`), resolved in the namespace
+    lambdify builds for numpy; newer ones print qualified names, e.g. `numpy.exp`.
+    """
+    namespace = dict(sym.lambdify((), 0, modules="numpy").__globals__)
+    namespace["numpy"] = np
+    return namespace
+
+
+def compile_fused_function(sym_functions, symbols, func_name="_fused_rates"):
+    """Generate a single python function that computes all the symbolic functions at once.
+
+    Common subexpressions across the functions are extracted with sympy `cse`, so that they are
+    computed only once; the results are written inside the `_out` array passed as last argument.
+
+    The symbols are renamed to generated identifiers, since their names (e.g. `lambda`) could be
+    invalid as arguments of a python function.
+    """
+    arguments = [sym.Symbol("_x{}".format(index)) for index in range(len(symbols))]
+    renaming = dict(zip(symbols, arguments))
+    sym_functions = [sym.sympify(function).xreplace(renaming) for function in sym_functions]
+
+    replacements, reduced = sym.cse(sym_functions, symbols=sym.numbered_symbols("_cse_"))
+    printer = _ElementwiseNumPyPrinter()
+
+    lines = ["def {}({}, _out):".format(func_name, ", ".join(str(s) for s in arguments))]
+    lines.extend("    {} = {}".format(cse_sym, printer.doprint(cse_expr))
+                 for cse_sym, cse_expr in replacements)
+    lines.extend("    _out[{}] = {}".format(idx, printer.doprint(expr))
+                 for idx, expr in enumerate(reduced))
+    lines.append("    return _out")
+    source = "\n".join(lines)
+    _LOGGER.debug("Generated fused function:\n%s", source)
+
+    namespace = _numpy_namespace()
+    exec(compile(source, "<boppy {}>".format(func_name), "exec"), namespace)
+    return namespace[func_name]
+
+
 class RateFunctionCollection(CommonProxyMethods):
     """Converts and handles RateFunction objects.
 
     Provides the callable magic method to compute each one of the converted functions on a vector.
 
+    When `compiled` is set, all the rate functions are fused into a single generated function,
+    where the subexpressions shared among rates are computed only once; otherwise each
+    RateFunction is called separately.
+
     Input: list of functions (passed as `strings`).
     """
 
-    def __init__(self, list_str_rate_functions, variables_collection, parameters_collection):
+    def __init__(self, list_str_rate_functions, variables_collection, parameters_collection,
+                 compiled=False):
         self._obj = [RateFunction(str_rate_function, variables_collection, parameters_collection)
                      for str_rate_function in list_str_rate_functions]
+        self._num_variables = len(variables_collection)
+        self.depends_on = [rate_function.depends_on_vector for rate_function in self._obj]
 
-    def __call__(self, vector):
-        """Compute each function of the collection on the input numpy vector."""
-        if vector.ndim != 1 or vector.shape[0] != len(self._obj):
-            raise InputError("Array shapes mismatch: input vector {}, rate "
-                             "functions {}.".format(vector.shape[0], len(self._obj)))
+        self._fused = None
+        if compiled:
+            variables_symbols = tuple(var.symbol for var in variables_collection.values())
+            self._fused = compile_fused_function([rf.sym_function for rf in self._obj],
+                                                 variables_symbols)
+
+    @property
+    def compiled(self):
+        return self._fused is not None
+
+    def __call__(self, vector, out=None):
+        """Compute each function of the collection on the input numpy vector.
+
+        The input can also be a 2D array of shape (species, trajectories): in that case each
+        column is a distinct state, and the output has shape (rate functions, trajectories).
+
+        In compiled mode an `out` array can be passed, to reuse it instead of allocating a new one.
+        """
+        if vector.ndim not in (1, 2) or vector.shape[0] != self._num_variables:
+            raise InputError("Array shapes mismatch: input vector {}, rate functions {} (expected "
+                             "{} variables).".format(vector.shape[0], len(self._obj),
+                                                     self._num_variables))
 
         # CHECK: the elements in the output should always be positive.
         # CHECK: should the sum of the output be equal/smaller than the system size?
-        return np.array(tuple(rate_func(vector) for rate_func in self))
+        if self._fused is not None:
+            if out is None:
+                out = np.empty((len(self._obj),) + vector.shape[1:])
+            if vector.ndim == 1:
+                return self._fused(*vector.tolist(), out)
+            return self._fused(*vector, out)
+
+        # Rates not depending on any variable return a scalar, which has to be expanded to the
+        # number of states evaluated.
+        return np.array(tuple(np.broadcast_to(rate_func(vector), vector.shape[1:])
+                              for rate_func in self))
+
+    def update_rates(self, vector, indices, out):
+        """Recompute inside `out` only the rate functions in positions `indices`.
+
+        This is what the simulators driven by a DependencyGraph rely on, so they require a
+        RateFunctionCollection, and not a generic callable, as `function_rates`. The graph has to
+        be built from the `depends_on` of the collection: a rate can depend on species that
+        aren't reagents of its reaction.
+        """
+        args = vector.tolist()
+        for index in indices:
+            out[index] = self._obj[index].lambdified(*args)
+        return out
 
 
 class ReactionCollection(CommonProxyMethods):
@@ -266,19 +401,105 @@ class ReactionCollection(CommonProxyMethods):
                      for reaction_to_be_parsed in list_str_reactions]
 
         self.update_matrix = np.stack((reac.update_vector for reac in self._obj))
+        self.reagents_matrix = np.stack([reac.reagents_vector for reac in self._obj])
         self.depends_on = np.array([reac.depends_on_vector for reac in self._obj])
         self.affects = np.array([reac.affects_vector for reac in self._obj])
 
 
+def _incidence_matrix(reactions_species, num_species):
+    """Build a sparse (reactions x species) matrix, with ones where a species is listed."""
+    lengths = [len(species) for species in reactions_species]
+    columns = np.concatenate([np.asarray(species, dtype=int).ravel()
+                              for species in reactions_species] + [np.empty(0, dtype=int)])
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(int)
+    return sparse.csr_matrix((np.ones(columns.shape[0], dtype=np.int32), columns, offsets),
+                             shape=(len(reactions_species), num_species))
+
+
 class DependencyGraph:
     """Create the dependency graph from the vector of variables and the vector of reactans.
 
     The variables in the vector change quantity when a reaction is executed.
+
+    The graph is obtained as the product of the sparse (reactions x species) incidence matrices
+    of affects and depends_on, and it is stored in CSR format: the reactions whose rate has to be
+    recomputed after the i-th one is executed are `indices[offsets[i]:offsets[i + 1]]`.
     """
 
     def __init__(self, affects, depends_on):
-        self.graph = defaultdict(set)
-        for affects_index, affects_reaction in enumerate(affects):
-            for depends_on_index, depends_on_reaction in enumerate(depends_on):
-                if np.intersect1d(affects_reaction, depends_on_reaction).shape[0] != 0:
-                    self.graph[affects_index].add(depends_on_index)
+        num_species = 1 + max((int(np.max(species)) for species in
+                               itertools.chain(affects, depends_on) if len(species) > 0),
+                              default=0)
+        graph = (_incidence_matrix(affects, num_species) *
+                 _incidence_matrix(depends_on, num_species).T).tocsr()
+        graph.sort_indices()
+
+        self.offsets = graph.indptr
+        self.indices = graph.indices
+
+    def __getitem__(self, reaction_index):
+        return self.indices[self.offsets[reaction_index]:self.offsets[reaction_index + 1]]
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+
+class ConservationLaws:
+    """Linear combinations of the species that no reaction changes, e.g. the total population.
+
+    The laws are the left null space of the (reactions x species) update matrix, computed exactly
+    with sympy and brought to reduced row echelon form: each law has a pivot, a dependent species
+    that can be expressed through the total of the law and the remaining, independent, species.
+
+    Given the totals of the laws, the full state is `reconstruction_matrix * x_independent +
+    offsets`, where `offsets` depends linearly on the totals.
+    """
+
+    def __init__(self, update_matrix):
+        update_matrix = np.asarray(update_matrix)
+        num_species = update_matrix.shape[1]
+
+        stoichiometry = sym.Matrix(update_matrix.tolist()).applyfunc(sym.nsimplify)
+        null_space = stoichiometry.nullspace()
+        if null_space:
+            laws, pivots = sym.Matrix.hstack(*null_space).T.rref()
+        else:
+            laws, pivots = sym.zeros(0, num_species), ()
+
+        self._laws = laws
+        self.matrix = np.array(laws.tolist(), dtype=float).reshape(len(pivots), num_species)
+        self.dependent = np.array(pivots, dtype=int)
+        self.independent = np.array([species for species in range(num_species)
+                                     if species not in pivots], dtype=int)
+        _LOGGER.debug("Found %d conservation laws, dependent species: %s", len(pivots),
+                      self.dependent)
+
+        # x_dependent = totals - laws[:, independent] * x_independent, since laws[:, dependent] = I.
+        self.reconstruction_matrix = np.zeros((num_species, self.independent.shape[0]))
+        self.reconstruction_matrix[self.independent, np.arange(self.independent.shape[0])] = 1
+        self.reconstruction_matrix[self.dependent] = -self.matrix[:, self.independent]
+
+    def __len__(self):
+        return self.dependent.shape[0]
+
+    def totals(self, states):
+        """Conserved quantities in the given state."""
+        return self.matrix.dot(states)
+
+    def offsets(self, totals):
+        full_offsets = np.zeros(self.matrix.shape[1])
+        full_offsets[self.dependent] = totals
+        return full_offsets
+
+    def reconstruct(self, independent_states, totals):
+        """Full states from the states of the independent species, by rows if 2D."""
+        return independent_states.dot(self.reconstruction_matrix.T) + self.offsets(totals)
+
+    def substitutions(self, symbols, totals):
+        """Dictionary to replace the symbols of the dependent species with the independent ones."""
+        independent_symbols = sym.Matrix(self.independent.shape[0], 1,
+                                         [symbols[species] for species in self.independent])
+        dependent_values = -self._laws.extract(list(range(len(self))),
+                                               self.independent.tolist()) * independent_symbols
+        return {symbols[species]: float(total) + value
+                for species, total, value in zip(self.dependent, totals, dependent_values)}
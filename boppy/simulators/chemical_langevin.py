@@ -0,0 +1,58 @@
+"""Integrate the Chemical Langevin Equation on a whole ensemble of trajectories at once.
+
+The CLE approximates the population process with a stochastic differential equation, where each
+reaction contributes to the drift with its rate and to the diffusion with the square root of it:
+
+    dX = U^T a(X) dt + U^T diag(sqrt(a(X))) dW
+
+As in `ssa_ensemble`, the states of all the iterations are stored in a (iterations x species)
+array, so that every time step is computed with vectorized numpy operations; the cost of each step
+doesn't depend on the number of events occurring in it.
+"""
+
+import numpy as np
+
+BOUNDARIES_AVAIL = ("truncate", "reflect")
+
+
+def chemical_langevin(update_matrix, initial_conditions, function_rates, t_max, **kwargs):
+    """Euler-Maruyama integration of the CLE for `kwargs["iterations"]` trajectories.
+
+    `function_rates` must accept a 2D array of shape (species, trajectories), as
+    RateFunctionCollection does.
+
+    Secondary arguments: `iterations`, and optionally the `time_step` (by default 1/1000 of t_max)
+    and the `boundary` condition used to keep the populations non negative: "truncate" (default)
+    sets negative values to zero, "reflect" takes their absolute value.
+
+    Returns a list with a (time + states) 2D array for each trajectory, as the CPU controller does.
+    """
+    iterations = kwargs["iterations"]
+    time_step = kwargs.get("time_step") or t_max / 1000
+    boundary = kwargs.get("boundary", "truncate")
+
+    num_steps = max(int(np.ceil(t_max / time_step)), 1)
+    times = np.linspace(0, t_max, num_steps + 1)
+    time_step = times[1] - times[0]
+
+    states = np.tile(np.asarray(initial_conditions, dtype=float), (iterations, 1))
+    trajectories_states = np.empty((iterations, num_steps + 1, states.shape[1]))
+    trajectories_states[:, 0] = states
+
+    for step in range(1, num_steps + 1):
+        # Rates can't be negative, e.g. when the states are slightly out of the domain.
+        rates = np.maximum(function_rates(states.T), 0)
+        firings = rates * time_step + np.sqrt(rates * time_step) * \
+            np.random.standard_normal(rates.shape)
+        states = states + firings.T.dot(update_matrix)
+
+        if boundary == "reflect":
+            np.abs(states, out=states)
+        else:
+            np.maximum(states, 0, out=states)
+
+        trajectories_states[:, step] = states
+
+    times_column = np.broadcast_to(times[:, np.newaxis], (num_steps + 1, 1))
+    return [np.hstack((times_column, trajectory_states))
+            for trajectory_states in trajectories_states]
@@ -0,0 +1,133 @@
+import math
+import numpy as np
+
+import boppy.core
+from ..utils.trajectory import TrajectoryBuffer
+
+
+class RejectionGroups:
+    """
+    Reactions grouped according to their rate: the g-th group contains the reactions with a rate in
+    [2^(g - 1), 2^g). Reactions with null rate don't belong to any group.
+
+    Each group keeps the list of its reactions and the sum of their rates; `position` maps every
+    reaction to its place in the group list, so that reactions can be moved among groups in O(1).
+    """
+
+    def __init__(self, rates):
+        self.members = {}
+        self.sums = {}
+        self.group = [None] * len(rates)
+        self.position = [0] * len(rates)
+
+        for reaction_index, rate in enumerate(rates):
+            self._insert(reaction_index, float(rate))
+
+    @property
+    def total(self):
+        return sum(self.sums.values())
+
+    def _insert(self, reaction_index, rate):
+        if rate <= 0:
+            self.group[reaction_index] = None
+            return
+
+        exponent = math.frexp(rate)[1]
+        members = self.members.setdefault(exponent, [])
+        self.group[reaction_index] = exponent
+        self.position[reaction_index] = len(members)
+        members.append(reaction_index)
+        self.sums[exponent] = self.sums.get(exponent, 0.) + rate
+
+    def _remove(self, reaction_index, rate):
+        exponent = self.group[reaction_index]
+        if exponent is None:
+            return
+
+        # Move the last reaction of the group in place of the one removed.
+        members = self.members[exponent]
+        last_reaction = members.pop()
+        if last_reaction != reaction_index:
+            members[self.position[reaction_index]] = last_reaction
+            self.position[last_reaction] = self.position[reaction_index]
+
+        if members:
+            self.sums[exponent] -= rate
+        else:
+            # Reset the empty groups, so that rounding errors don't accumulate.
+            del self.members[exponent], self.sums[exponent]
+        self.group[reaction_index] = None
+
+    def update(self, reaction_index, old_rate, new_rate):
+        old_rate, new_rate = float(old_rate), float(new_rate)
+        exponent = self.group[reaction_index]
+        if new_rate > 0 and exponent is not None and math.frexp(new_rate)[1] == exponent:
+            self.sums[exponent] += new_rate - old_rate
+        else:
+            self._remove(reaction_index, old_rate)
+            self._insert(reaction_index, new_rate)
+
+    def select(self, rates, random_value):
+        """Select a group by linear search on the group sums, then a reaction inside it by
+        rejection: the expected number of trials is smaller than 2, whatever the group size.
+        """
+        chosen_exponent = None
+        for chosen_exponent, group_sum in self.sums.items():
+            if random_value <= group_sum:
+                break
+            random_value -= group_sum
+
+        members = self.members[chosen_exponent]
+        upper_bound = math.ldexp(1., chosen_exponent)
+        while True:
+            candidate = members[int(np.random.random_sample() * len(members))]
+            if np.random.random_sample() * upper_bound < rates[candidate]:
+                return candidate
+
+
+def composition_rejection(update_matrix, initial_conditions, function_rates, t_max, **kwargs):
+    """
+    This function implements the SSA with Composition-Rejection from Slepoy, Thompson and Plimpton.
+
+    Reactions are grouped by rate in power-of-two bins: a group is chosen with a linear search over
+    the (few) groups, and a reaction inside the group with rejection sampling, so the cost of each
+    step doesn't grow with the number of reactions. As in the optimized direct method, only the
+    rates of the reactions depending on the one executed are recomputed.
+
+    See `RateFunctionCollection.update_rates` for the requirements on `function_rates` and on the
+    `depends_on` secondary argument.
+
+    References:
+    A. Slepoy, A.P. Thompson and S.J. Plimpton "A constant-time kinetic Monte Carlo algorithm for
+    simulation of large biochemical reaction networks", The Journal of Chemical Physics, 2008,
+    128 (20), 205101
+    """
+    dependency_graph = boppy.core.DependencyGraph(kwargs['affects'], kwargs['depends_on'])
+
+    states = np.copy(initial_conditions)
+    rates = np.array(function_rates(states), dtype=float)
+    old_rates = np.copy(rates)
+    groups = RejectionGroups(rates)
+
+    trajectory = TrajectoryBuffer(states.shape[0])
+    trajectory.append(0, states)
+
+    simul_t = 0
+    while simul_t < t_max:
+        total_rate = groups.total
+        if total_rate <= 0 or not groups.members:
+            break
+
+        simul_t -= np.log(1 - np.random.random_sample()) / total_rate
+        reaction = groups.select(rates, (1 - np.random.random_sample()) * total_rate)
+        states += update_matrix[reaction, :]
+
+        dependent_reactions = dependency_graph[reaction]
+        function_rates.update_rates(states, dependent_reactions, rates)
+        for reaction_index in dependent_reactions:
+            groups.update(reaction_index, old_rates[reaction_index], rates[reaction_index])
+            old_rates[reaction_index] = rates[reaction_index]
+
+        trajectory.append(simul_t, states)
+
+    return trajectory.to_array()
@@ -1,84 +1,292 @@
+from functools import lru_cache
+import multiprocessing as mp
 import numpy as np
+from scipy import sparse
 import sympy as sym
-from scipy.integrate import odeint
+from scipy.integrate import odeint, solve_ivp
+
+from boppy.core import compile_fused_function, ConservationLaws
+
+# `odeint` uses LSODA from ODEPACK; the other ones are the methods of `scipy.integrate.solve_ivp`.
+ODE_SOLVERS_AVAIL = ("odeint", "LSODA", "BDF", "Radau", "RK45", "RK23")
+
+# Implicit solvers, which make use of the jacobian.
+_SOLVERS_WITH_JACOBIAN = ("odeint", "LSODA", "BDF", "Radau")
+
+# Solvers that accept the jacobian as a sparse matrix.
+_SOLVERS_WITH_SPARSE_JACOBIAN = ("BDF", "Radau")
+
+
+def density_symbols(variables):
+    """Dictionary to substitute individuals variables symbols with densities variables symbols."""
+    return {var_obj.symbol: sym.Symbol('d_' + var_obj.str_var) for var_obj in variables.values()}
+
+
+def _leading_order_term(f_N, system_size_symbol):
+    """Limit of `f_N` for N to infinity, when `f_N` is a rational function of N.
+
+    The limit is read directly from the leading coefficients of numerator and denominator, seen as
+    polynomials in N; None is returned when the expression isn't rational in N, or it diverges.
+    """
+    numerator, denominator = sym.fraction(sym.together(sym.expand(f_N)))
+    try:
+        numerator = sym.Poly(numerator, system_size_symbol)
+        denominator = sym.Poly(denominator, system_size_symbol)
+    except sym.PolynomialError:
+        return None
+
+    if numerator.degree() < denominator.degree():
+        return sym.Integer(0)
+    elif numerator.degree() == denominator.degree():
+        return numerator.LC() / denominator.LC()
+    return None
+
+
+@lru_cache(maxsize=128)
+def _scale_sym_functions(sym_functions, substitutions, system_size_symbol):
+    f_functions_vector = []
+    for sym_function in sym_functions:
+        # Each species (individuals) becomes the system size times its density.
+        f_N = sym_function.subs(substitutions) / system_size_symbol
+
+        f = _leading_order_term(f_N, system_size_symbol)
+        if f is None:
+            f = sym.limit(f_N, system_size_symbol, sym.oo)
+        f_functions_vector.append(f)
+
+    return tuple(f_functions_vector)
+
+
+def scaling(rate_functions_vector, substitutor_dict, system_size):
+    """
+    This function scales the rate functions, normalizing individuals variables with densities
+    variables, and calculate the limit f for each one, a function required to be locally
+    Lipschitz continuos and bounded. This function is needed to calculate the limit vector
+    field (limit of the drift).
+
+    For polynomial and rational rates the limit is obtained from the leading order term in N,
+    while `sym.limit` is used only for the other ones. Results are cached per model, so repeated
+    runs on the same rate functions skip the symbolic work.
+    """
+    return _scale(tuple(ratefun.sym_function for ratefun in rate_functions_vector),
+                  substitutor_dict, system_size)
+
+
+def _scale(sym_functions, substitutor_dict, system_size):
+    substitutions = tuple((var_symbol, system_size.symbol * density_symbol)
+                          for var_symbol, density_symbol in substitutor_dict.items())
+    return list(_scale_sym_functions(sym_functions, substitutions, system_size.symbol))
+
+
+def create_equations(np_matrix, symbolic_functions_vector):
+    """
+    Matrix product between the transposed update matrix and a vector of symbolic functions.
+
+    It creates a list of equations, one for each species: the drift of the i-th species is the
+    sum of the rates of the reactions, weighted by how much each reaction changes the species.
+    """
+    return [sum(f * elem for f, elem in zip(symbolic_functions_vector, column) if elem != 0)
+            for column in np.asarray(np_matrix).T]
+
+
+class CompiledDrift:
+    """Drift vector and its jacobian, compiled once into numpy callables.
+
+    Both are generated with `compile_fused_function`, so common subexpressions are computed once.
+    The symbols in `parameters` are left as arguments of the compiled functions, so that their
+    values can be changed without compiling again; they're renamed in the generated code, so
+    names that are python keywords, e.g. `lambda`, are accepted.
+
+    States (and parameters) can also be 2D arrays, with a column for each copy of the system:
+    the drift and the jacobian then get an additional last axis.
+    """
+
+    def __init__(self, equations, symbols, parameters=()):
+        self.num_equations = len(equations)
+        jacobian = sym.Matrix(equations).jacobian(sym.Matrix(symbols))
+
+        arguments = list(symbols) + list(parameters)
+        self._drift = compile_fused_function(equations, arguments, "_drift")
+        self._jacobian = compile_fused_function(list(jacobian), arguments, "_jacobian")
+
+    def drift(self, x, parameters=()):
+        out = np.empty((self.num_equations,) + np.shape(x)[1:])
+        return self._drift(*x, *parameters, out)
+
+    def jacobian(self, x, parameters=()):
+        out = np.empty((self.num_equations ** 2,) + np.shape(x)[1:])
+        return self._jacobian(*x, *parameters, out).reshape(
+            (self.num_equations, self.num_equations) + np.shape(x)[1:])
+
+
+class StackedDrift:
+    """K copies of a compiled drift, one for each set of parameters, stacked in a single system.
+
+    The state is the concatenation of the K states; the jacobian is block diagonal, and it's
+    returned as a sparse CSR matrix, whose structure is computed once.
+    """
+
+    def __init__(self, compiled_drift, parameters_values):
+        self._compiled_drift = compiled_drift
+        self._parameters_values = np.asarray(parameters_values, dtype=float)
+        self._num_copies = self._parameters_values.shape[1]
+        self.num_equations = compiled_drift.num_equations * self._num_copies
+
+        # Block k spans the rows and columns from k * E to (k + 1) * E, with E equations each.
+        block_size = compiled_drift.num_equations
+        self._indices = np.tile(np.arange(block_size), block_size * self._num_copies) + \
+            np.repeat(np.arange(self._num_copies) * block_size, block_size ** 2)
+        self._indptr = np.arange(0, block_size * self.num_equations + 1, block_size)
+
+    def _unstack(self, x):
+        return np.reshape(x, (self._num_copies, -1)).T
+
+    def drift(self, x):
+        return self._compiled_drift.drift(self._unstack(x), self._parameters_values).T.ravel()
+
+    def jacobian(self, x):
+        blocks = self._compiled_drift.jacobian(self._unstack(x), self._parameters_values)
+        return sparse.csr_matrix((np.transpose(blocks, (2, 0, 1)).ravel(), self._indices,
+                                  self._indptr), shape=(self.num_equations, self.num_equations))
+
+
+def _dense_jacobian(compiled_drift, x):
+    jacobian = compiled_drift.jacobian(x)
+    return jacobian.toarray() if sparse.issparse(jacobian) else jacobian
+
+
+def integrate(compiled_drift, initial_conditions, t, ode_solver=None):
+    """Integrate the drift on the times `t`, with the chosen solver; return the states."""
+    if ode_solver in (None, "odeint"):
+        return odeint(lambda x, _: compiled_drift.drift(x), initial_conditions, t,
+                      Dfun=lambda x, _: _dense_jacobian(compiled_drift, x))
+
+    solver_options = {}
+    if ode_solver in _SOLVERS_WITH_SPARSE_JACOBIAN:
+        solver_options["jac"] = lambda _, x: compiled_drift.jacobian(x)
+    elif ode_solver in _SOLVERS_WITH_JACOBIAN:
+        solver_options["jac"] = lambda _, x: _dense_jacobian(compiled_drift, x)
+    solution = solve_ivp(lambda _, x: compiled_drift.drift(x), (t[0], t[-1]), initial_conditions,
+                         method=ode_solver, t_eval=t, **solver_options)
+    if not solution.success:
+        raise RuntimeError("The integration of the ODE system with {} failed: "
+                           "{}".format(ode_solver, solution.message))
+    return solution.y.T
+
+
+def _reduced_equations(update_matrix, d_initial_conditions, sym_functions, variables,
+                       system_size):
+    """Equations of the fluid limit for the densities of the species not fixed by conservation
+    laws; return the laws, their totals, the equations and the densities symbols.
+    """
+    var_to_substitute = density_symbols(variables)
+    f_funcs = _scale(tuple(sym_functions), var_to_substitute, system_size)
+
+    laws = ConservationLaws(update_matrix)
+    totals = laws.totals(d_initial_conditions)
+    d_symbols = list(var_to_substitute.values())
+    substitutions = laws.substitutions(d_symbols, totals)
+    equations = create_equations(update_matrix, f_funcs)
+
+    return (laws, totals, [equations[species].subs(substitutions) for species in laws.independent],
+            [d_symbols[species] for species in laws.independent])
 
 
 def fluid_approximation(update_matrix, initial_conditions, function_rates, t_max, **kwargs):
     """
-    Mean field - fluid approximation method - returns a deterministic model for populations 
-    processes, that represents species trajectories for 'large system size' (studies the 
+    Mean field - fluid approximation method - returns a deterministic model for populations
+    processes, that represents species trajectories for 'large system size' (studies the
     limit to infinite).
     Secondary arguments. In these rate functions variable system size is represented by N.
-    Also needed the costant system size.
+    Also needed the system size Parameter, and optionally the name of the `ode_solver` to use
+    (one of ODE_SOLVERS_AVAIL, by default `odeint`).
+
+    The drift and its jacobian are built symbolically and compiled once, before the integration.
+    Species made dependent by conservation laws are eliminated from the system, and reconstructed
+    from the conserved totals at the end.
     """
 
     rate_funcs_N = kwargs["rate_functions_var_ss"]
     variables = kwargs["variables"]
     system_size = kwargs["system_size"]
 
-    def variables_involved(rate_func):
-        """
-        Extract the vector of species involved in a certain rate function. List of symbols.
-        """
-        sym_rate_func = rate_func.sym_function
-        species_inv = [sym_el for sym_el in sym_rate_func.args if sym_el.is_symbol]
-        return species_inv
-
-    def scaling(rate_functions_vector, substitutor_dict):
-        """
-        This function scales the rate functions, normalizing individuals variables with densities
-        variables, and calculate the limit f for each one, a function required to be locally
-        Lipschitz continuos and bounded. This function is needed to calculate the limit vector
-        field (limit of the drift).
-        """
-
-        f_functions_vector = []
-        for ratefun in rate_functions_vector:
-            n = len(variables_involved(ratefun))
-            ratefun = ratefun.sym_function.subs(substitutor_dict)
-            ratefun_normalized = ratefun * (system_size.symbol**n)
-            f_N = ratefun_normalized / system_size.symbol
-            f = sym.limit(f_N, system_size.symbol, sym.oo)
-            f_functions_vector.append(f)
-
-        return f_functions_vector
-
-    def create_equations(np_matrix, symbolic_functions_vector):
-        """
-        Matrix product between a numerical matrix and a vector of symbolic functions.
-
-        It creates a list of linear equations.
-        """
-        eqs_list = []
-        for row in np_matrix:
-            eqs_list.append(sum(f * elem for f, elem in zip(symbolic_functions_vector, row)))
-
-        return eqs_list
-
-    def ode_model(x, t):
-        """
-        Generate the correct input for 'odeint'.
-
-        Odeint is a function that needs a vector of initial conditions and time.
-
-        TODO: Check whether a generator could be returned instead of a list.
-        """
-
-        return [equation.evalf(subs=dict(zip(var_to_substitute.values(), x)))
-                for equation in create_equations(update_matrix, f_funcs)]
-
-    # Dictionary to substitute individuals variables symbols with densities variables symbols.
-    var_to_substitute = {}
-    for var_obj in variables.values():
-        var_to_substitute[var_obj.symbol] = sym.Symbol('d_' + var_obj.str_var)
-
-    f_funcs = scaling(rate_funcs_N, var_to_substitute)
-
-    d_initial_conditions = [x / system_size.value for x in initial_conditions]
+    d_initial_conditions = np.asarray(initial_conditions, dtype=float) / system_size.value
+    laws, totals, equations, d_symbols = _reduced_equations(
+        update_matrix, d_initial_conditions,
+        [rate_func.sym_function for rate_func in rate_funcs_N], variables, system_size)
+
+    compiled_drift = CompiledDrift(equations, d_symbols)
+
     t = np.linspace(0, t_max, 1000)
 
-    trajectories_states = odeint(ode_model, d_initial_conditions, t)
+    independent_states = integrate(compiled_drift, d_initial_conditions[laws.independent], t,
+                                   kwargs.get("ode_solver"))
+    trajectories_states = laws.reconstruct(independent_states, totals)
     trajectories_times = t
 
     # Pack together the time column with the states associated to it.
     return np.c_[trajectories_times, trajectories_states]
+
+
+def _integrate_sweep_chunk(chunk):
+    """Integrate the stacked systems of a chunk of parameter sets; run inside the workers."""
+    equations, d_symbols, parameters_symbols, parameters_values, y0, t, ode_solver = chunk
+
+    stacked_drift = StackedDrift(CompiledDrift(equations, d_symbols, parameters_symbols),
+                                 parameters_values)
+    states = integrate(stacked_drift, np.tile(y0, parameters_values.shape[1]), t, ode_solver)
+    return np.transpose(states.reshape(t.shape[0], parameters_values.shape[1], -1), (1, 0, 2))
+
+
+def fluid_approximation_sweep(update_matrix, initial_conditions, function_rates, t_max,
+                              **kwargs):
+    """
+    Fluid approximation for many sets of parameters, integrated together as a single system.
+
+    The drift is compiled once, with the parameters as arguments; the K systems are stacked into
+    a (K * S)-dimensional one, with a block diagonal sparse jacobian. With `processes` > 1 the
+    parameter sets are split in chunks, each one integrated by a different process: only the
+    symbolic equations are sent to the processes, where they are compiled again.
+
+    Secondary arguments: the same of `fluid_approximation`, plus `parameters` (the
+    ParameterCollection with the default values) and `parameters_sets`, a list of dictionaries
+    {parameter name: value} overriding the defaults; optionally the number of `processes`.
+    The default `ode_solver` is BDF, which makes use of the sparse jacobian.
+
+    Returns a (K x times x (1 + species)) array, with a trajectory for each parameters set.
+    """
+    rate_funcs_N = kwargs["rate_functions_var_ss"]
+    variables = kwargs["variables"]
+    system_size = kwargs["system_size"]
+    parameters = kwargs["parameters"]
+    parameters_sets = kwargs["parameters_sets"]
+    ode_solver = kwargs.get("ode_solver") or "BDF"
+    processes = kwargs.get("processes", 1)
+
+    d_initial_conditions = np.asarray(initial_conditions, dtype=float) / system_size.value
+    laws, totals, equations, d_symbols = _reduced_equations(
+        update_matrix, d_initial_conditions,
+        [rate_func.sym_function_with_params for rate_func in rate_funcs_N], variables,
+        system_size)
+
+    parameters_symbols = [param.symbol for param in parameters.values()]
+    parameters_values = np.array([[parameters_set.get(name, param.value)
+                                   for parameters_set in parameters_sets]
+                                  for name, param in parameters.items()],
+                                 dtype=float).reshape(len(parameters_symbols),
+                                                      len(parameters_sets))
+
+    t = np.linspace(0, t_max, 1000)
+    y0 = d_initial_conditions[laws.independent]
+    num_chunks = max(1, min(processes, len(parameters_sets)))
+    chunks = [(equations, d_symbols, parameters_symbols, values, y0, t, ode_solver)
+              for values in np.array_split(parameters_values, num_chunks, axis=1)]
+    if len(chunks) == 1:
+        independent_states = _integrate_sweep_chunk(chunks[0])
+    else:
+        with mp.Pool(processes=len(chunks)) as pool:
+            independent_states = np.concatenate(pool.map(_integrate_sweep_chunk, chunks))
+
+    trajectories_states = laws.reconstruct(independent_states, totals)
+    trajectories_times = np.broadcast_to(t[:, np.newaxis], (len(parameters_sets),) + t.shape + (1,))
+    return np.concatenate((trajectories_times, trajectories_states), axis=2)
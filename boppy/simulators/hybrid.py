@@ -0,0 +1,135 @@
+"""Hybrid simulator: fast reactions are integrated as ODEs, slow ones are simulated exactly.
+
+Reactions are split into a fast/continuous set and a slow/discrete set: the former changes the
+populations through the deterministic drift, while the latter fires as in the SSA. The time of the
+next slow event is found by integrating the total slow rate along the ODE solution, together with
+the populations, until it reaches the threshold -ln(r), with r uniform in (0, 1].
+
+The partition can be fixed by the user, or recomputed from the current rates and populations:
+a reaction is fast when its rate is high and all the species it changes are abundant.
+"""
+
+import numpy as np
+from scipy.integrate import solve_ivp
+
+from ..utils.trajectory import TrajectoryBuffer
+
+
+def partition_reactions(update_matrix, states, rates, rate_threshold, population_threshold):
+    """Boolean mask of the reactions to treat as fast in the current state.
+
+    A reaction is fast if its rate is at least `rate_threshold`, and all the species changed by it
+    have at least `population_threshold` individuals.
+    """
+    changed = update_matrix != 0
+    abundant = np.all(~changed | (states >= population_threshold), axis=1)
+    return (rates >= rate_threshold) & abundant
+
+
+def _integrate_fast_reactions(update_matrix, states, simul_t, t_end, function_rates, fast,
+                              threshold, ode_solver, trajectory):
+    """Integrate the fast reactions from `simul_t` up to `t_end`, or up to the next slow event.
+
+    Returns the time and the states reached, the integrated slow rate, and whether the integration
+    stopped at a slow event.
+    """
+    fast_matrix = update_matrix * fast[:, np.newaxis]
+    slow = ~fast
+
+    def drift(_, y):
+        rates = np.maximum(function_rates(y[:-1]), 0)
+        return np.append(rates.dot(fast_matrix), rates[slow].sum())
+
+    def slow_event(_, y):
+        return y[-1] - threshold
+    slow_event.terminal, slow_event.direction = True, 1
+
+    solution = solve_ivp(drift, (simul_t, t_end), np.append(states, 0), method=ode_solver,
+                         events=slow_event)
+    if solution.status == -1:
+        raise RuntimeError("The integration of the fast reactions with {} failed: "
+                           "{}".format(ode_solver, solution.message))
+
+    # Intermediate steps of the solver are recorded, the last one is left to the caller.
+    for time, y in zip(solution.t[1:-1], solution.y[:-1, 1:-1].T):
+        trajectory.append(time, np.maximum(y, 0))
+
+    return (solution.t[-1], np.maximum(solution.y[:-1, -1], 0), solution.y[-1, -1],
+            solution.status == 1)
+
+
+def hybrid_ssa_ode(update_matrix, initial_conditions, function_rates, t_max, **kwargs):
+    """
+    Hybrid SSA/ODE simulation of a multiscale model.
+
+    Secondary arguments, all optional:
+    - `fast_reactions`: boolean mask (or indices) of the reactions to integrate as ODEs; when not
+      given, the partition is recomputed after each slow event and every `partition_interval`
+      time units, with the `rate_threshold` and the `population_threshold`
+      (see `partition_reactions`);
+    - `ode_solver`: the method of `scipy.integrate.solve_ivp` to use, LSODA by default.
+
+    Species changed by fast reactions take real values; those changed only by slow reactions keep
+    integer populations.
+
+    References:
+    E.L. Haseltine and J.B. Rawlings "Approximate simulation of coupled fast and slow reactions
+    for stochastic chemical kinetics", The Journal of Chemical Physics, 2002, 117 (15), 6959
+    """
+    num_reactions = update_matrix.shape[0]
+    fast_reactions = kwargs.get("fast_reactions")
+    rate_threshold = kwargs.get("rate_threshold", 10)
+    population_threshold = kwargs.get("population_threshold", 100)
+    partition_interval = kwargs.get("partition_interval") or t_max / 100
+    ode_solver = kwargs.get("ode_solver") or "LSODA"
+    if ode_solver == "odeint":
+        ode_solver = "LSODA"
+
+    static_partition = fast_reactions is not None
+    if static_partition:
+        fast = np.zeros(num_reactions, dtype=bool)
+        fast[np.asarray(fast_reactions)] = True
+
+    states = np.array(initial_conditions, dtype=float)
+    trajectory = TrajectoryBuffer(states.shape[0])
+    trajectory.append(0, states)
+
+    simul_t = 0
+    # Integrated slow rate needed before the next slow event: exponentially distributed.
+    threshold = -np.log(1 - np.random.random_sample())
+    while simul_t < t_max:
+        rates = np.maximum(function_rates(states), 0)
+        if not static_partition:
+            fast = partition_reactions(update_matrix, states, rates, rate_threshold,
+                                       population_threshold)
+
+        if np.any(fast & (rates > 0)):
+            t_end = t_max if static_partition else min(simul_t + partition_interval, t_max)
+            simul_t, states, integrated_slow_rate, slow_event = _integrate_fast_reactions(
+                update_matrix, states, simul_t, t_end, function_rates, fast, threshold,
+                ode_solver, trajectory)
+            if not slow_event:
+                # No slow event before t_end: keep the residual threshold.
+                threshold -= integrated_slow_rate
+                trajectory.append(simul_t, states)
+                continue
+            rates = np.maximum(function_rates(states), 0)
+        else:
+            # Without fast reactions the slow rates are constant until the next event.
+            total_slow_rate = rates[~fast].sum()
+            if total_slow_rate <= 0:
+                break
+            simul_t += threshold / total_slow_rate
+
+        slow_rates = np.where(fast, 0, rates)
+        cumulative_rates = np.cumsum(slow_rates)
+        if cumulative_rates[-1] <= 0:
+            threshold = -np.log(1 - np.random.random_sample())
+            continue
+        rnd_react = (1 - np.random.random_sample()) * cumulative_rates[-1]
+        states += update_matrix[min(np.searchsorted(cumulative_rates, rnd_react),
+                                    num_reactions - 1)]
+        trajectory.append(simul_t, states)
+        threshold = -np.log(1 - np.random.random_sample())
+
+    return trajectory.to_array()
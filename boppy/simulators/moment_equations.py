@@ -0,0 +1,125 @@
+"""Deterministic approximations of the first two moments of a population process.
+
+Instead of averaging many stochastic trajectories, the ODEs for the means and the covariances of
+the species are derived symbolically from the update matrix and the rate functions, and then
+integrated once:
+
+- the linear noise approximation (LNA) evaluates the rates and their jacobian on the means;
+- the second order moment closure (normal, or gaussian, closure) also adds to the expected rates
+  the correction given by their hessian and the covariances, neglecting the cumulants of order
+  higher than two.
+
+For a model with S species the system has S + S * (S + 1) / 2 equations; species made dependent
+by conservation laws are eliminated before building it, and their moments are reconstructed from
+the other ones. Both methods return the times, then the S means, then the S * S covariance matrix
+flattened by rows.
+"""
+
+import numpy as np
+import sympy as sym
+
+from boppy.core import ConservationLaws
+from .fluid_approximation import CompiledDrift, integrate
+
+
+def _covariance_symbols(variables_symbols):
+    """Symmetric matrix of covariance symbols, and the list of its independent entries."""
+    num_species = len(variables_symbols)
+    covariance = sym.zeros(num_species, num_species)
+    independent = []
+    for i in range(num_species):
+        for j in range(i, num_species):
+            covariance[i, j] = covariance[j, i] = sym.Symbol("cov_{}_{}".format(
+                variables_symbols[i], variables_symbols[j]))
+            independent.append(covariance[i, j])
+    return covariance, independent
+
+
+def moment_equations(update_matrix, sym_rates, variables_symbols, closure=False):
+    """Build the means and covariances equations; return them with the symbols of the system.
+
+    The rates of the reactions are evaluated on the means; when `closure` is set, the expected
+    rates are corrected with the second order terms, E[a(x)] ~ a(m) + 1/2 tr(H_a(m) C).
+    """
+    update_transposed = sym.Matrix(np.asarray(update_matrix, dtype=float).T)
+    rates = sym.Matrix(sym_rates)
+    states = sym.Matrix(variables_symbols)
+    covariance, covariance_independent = _covariance_symbols(variables_symbols)
+    num_species = len(variables_symbols)
+
+    rates_jacobian = rates.jacobian(states)
+    expected_rates = rates
+    if closure:
+        hessians = [sym.hessian(rate, states) for rate in rates]
+        expected_rates = sym.Matrix([
+            rate + sum(hessian[i, j] * covariance[i, j]
+                       for i in range(num_species) for j in range(num_species)) / 2
+            for rate, hessian in zip(rates, hessians)])
+
+    means_equations = update_transposed * expected_rates
+
+    drift_jacobian = update_transposed * rates_jacobian
+    diffusion = update_transposed * sym.diag(*expected_rates) * update_transposed.T
+    covariance_equations = (drift_jacobian * covariance + covariance * drift_jacobian.T +
+                            diffusion)
+
+    equations = list(means_equations) + [covariance_equations[i, j]
+                                         for i in range(num_species)
+                                         for j in range(i, num_species)]
+    return equations, list(variables_symbols) + covariance_independent
+
+
+def _solve_moment_equations(update_matrix, initial_conditions, function_rates, t_max, closure,
+                            **kwargs):
+    variables_symbols = [var.symbol for var in kwargs["variables"].values()]
+    initial_conditions = np.asarray(initial_conditions, dtype=float)
+
+    # The moments of the dependent species are linear functions of the independent ones.
+    laws = ConservationLaws(update_matrix)
+    totals = laws.totals(initial_conditions)
+    substitutions = laws.substitutions(variables_symbols, totals)
+    independent_symbols = [variables_symbols[species] for species in laws.independent]
+    num_species = len(independent_symbols)
+
+    equations, symbols = moment_equations(update_matrix[:, laws.independent],
+                                          [rate_func.sym_function.subs(substitutions)
+                                           for rate_func in function_rates],
+                                          independent_symbols, closure)
+
+    # The initial conditions are deterministic, so they have null covariance.
+    initial_moments = np.zeros(len(symbols))
+    initial_moments[:num_species] = initial_conditions[laws.independent]
+
+    t = np.linspace(0, t_max, 1000)
+    moments = integrate(CompiledDrift(equations, symbols), initial_moments, t,
+                        kwargs.get("ode_solver"))
+
+    upper_rows, upper_cols = np.triu_indices(num_species)
+    covariances = np.empty((t.shape[0], num_species, num_species))
+    covariances[:, upper_rows, upper_cols] = moments[:, num_species:]
+    covariances[:, upper_cols, upper_rows] = moments[:, num_species:]
+
+    reconstruction = laws.reconstruction_matrix
+    means = laws.reconstruct(moments[:, :num_species], totals)
+    covariances = np.matmul(np.matmul(reconstruction, covariances), reconstruction.T)
+
+    return np.c_[t, means, covariances.reshape(t.shape[0], -1)]
+
+
+def linear_noise_approximation(update_matrix, initial_conditions, function_rates, t_max,
+                               **kwargs):
+    """Means and covariances of the species according to the Linear Noise Approximation.
+
+    Secondary arguments: the `variables` collection, and optionally the `ode_solver` to use.
+    """
+    return _solve_moment_equations(update_matrix, initial_conditions, function_rates, t_max,
+                                   closure=False, **kwargs)
+
+
+def moment_closure(update_matrix, initial_conditions, function_rates, t_max, **kwargs):
+    """Means and covariances of the species according to the second order normal moment closure.
+
+    Secondary arguments: the `variables` collection, and optionally the `ode_solver` to use.
+    """
+    return _solve_moment_equations(update_matrix, initial_conditions, function_rates, t_max,
+                                   closure=True, **kwargs)
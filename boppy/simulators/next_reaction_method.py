@@ -1,6 +1,7 @@
+from array import array
 import numpy as np
 import boppy.core
-from collections import namedtuple
+from boppy.utils.trajectory import TrajectoryBuffer
 np.seterr(divide='ignore', invalid='ignore')
 
 
@@ -23,8 +24,7 @@ def next_reaction_method(update_matrix, initial_mol_number, propensity_function,
 
     num_reactions = np.shape(update_matrix)[0]
 
-    trajectory_states = []   # States
-    trajectory_ftimes = []   # Firing times
+    trajectory = TrajectoryBuffer(mol_number.shape[0])   # Firing times and states
 
     # Generate a dependecy graph
     dependecy_graph = boppy.core.DependencyGraph(affects_vector, depends_on_vector)
@@ -38,16 +38,14 @@ def next_reaction_method(update_matrix, initial_mol_number, propensity_function,
     putative_times[np.isnan(putative_times)] = np.inf   # 0/0 set to inf
 
     # Store the putative times in a indexed priority queue
-    nodes_list = [IPQnode(index, time) for index, time in enumerate(putative_times)]
-    ipq = IndexedPriorityQueue(nodes_list)
+    ipq = IndexedPriorityQueue(putative_times)
 
     while time_simul < t_max:
 
-        trajectory_states.append(np.copy(mol_number))
-        trajectory_ftimes.append(time_simul)
+        trajectory.append(time_simul, mol_number)
 
         # Select the reaction whose putative time is least
-        next_reaction_index = ipq.tree[0].index
+        next_reaction_index = ipq.min_index
 
         # Change the number of molecules to reflect execution of reaction
         mol_number += update_matrix[next_reaction_index]
@@ -57,7 +55,7 @@ def next_reaction_method(update_matrix, initial_mol_number, propensity_function,
         propensity_val_new = propensity_function(mol_number)
 
         # Update the putative times and the indexed priority queue
-        for reaction_index in dependecy_graph.graph[next_reaction_index]:
+        for reaction_index in dependecy_graph[next_reaction_index]:
             if (reaction_index == next_reaction_index) or (propensity_val[reaction_index] == 0 and propensity_val_new[reaction_index] != 0):
                 putative_times[reaction_index] = - 1 / propensity_val_new[reaction_index] * \
                     np.log(np.random.random(1)) + time_simul
@@ -67,75 +65,95 @@ def next_reaction_method(update_matrix, initial_mol_number, propensity_function,
             if np.isnan(putative_times[reaction_index]):
                 putative_times[reaction_index] = np.inf
 
-            ipq.update(IPQnode(reaction_index, putative_times[reaction_index]))
+            ipq.update(reaction_index, putative_times[reaction_index])
 
         # Update the propensity functions
         propensity_val = np.copy(propensity_val_new)
 
-    # Pack together the time column with the states associated to it.
-    return np.c_[trajectory_ftimes, trajectory_states]
-
-
-IPQnode = namedtuple('Node', ['index', 'time'])  # Node of the Indexed Priority Queue
+    # The time column is already packed together with the states associated to it.
+    return trajectory.to_array()
 
 
 class IndexedPriorityQueue:
     """
-    An indexed priority queue consists of a tree structure of ordered IPQnode (pairs of reaction's index and putative time)
-    and a dictionary where the i-th key is mapped to the position in the tree that contains the IPQnode whose index is i.
+    An indexed priority queue consists of a tree structure of ordered pairs of reaction's index and putative time,
+    and of a map from the i-th reaction index to the position in the tree that contains the pair whose index is i.
     The tree structure has the property that each parent has a lower putative time than either of its children (heap).
+
+    The tree is stored in two parallel `array` buffers (times and reaction indices), and the map in a third one, so
+    that updates only overwrite entries in place, without allocating new objects.
     """
 
-    def __init__(self, nodes_list):
-        self.tree = nodes_list
-        self.dict = {node.index: index for index, node in enumerate(nodes_list)}
+    def __init__(self, putative_times):
+        self.times = array('d', putative_times)
+        self.indices = array('l', range(len(self.times)))
+        self.positions = array('l', range(len(self.times)))
         self._built()
 
-    def _built(self):
-        """Moves entries until the tree has the property that each parent is less than its children."""
-        for node_index in range(len(self.tree) // 2 - 1, -1, -1):
-            self._heapify(node_index)
-
-    def _heapify(self, node_index):
-        smallest = node_index
-        left = 2 * node_index + 1
-        right = 2 * node_index + 2
+    @property
+    def min_index(self):
+        """Index of the reaction with the least putative time."""
+        return self.indices[0]
 
-        if left < len(self.tree) and self.tree[left].time < self.tree[smallest].time:
-            smallest = left
+    @property
+    def min_time(self):
+        return self.times[0]
 
-        if right < len(self.tree) and self.tree[right].time < self.tree[smallest].time:
-            smallest = right
+    def __len__(self):
+        return len(self.times)
 
-        if smallest != node_index:
-            self._swap(smallest, node_index)
-            self._heapify(smallest)
+    def _built(self):
+        """Moves entries until the tree has the property that each parent is less than its children."""
+        for node_index in range(len(self.times) // 2 - 1, -1, -1):
+            self._sift_down(node_index)
 
     def _swap(self, node_i, node_j):
-        """Swaps the tree nodes node_i and node_j and updates the dictionary appropriately"""
-        self.tree[node_i], self.tree[node_j] = self.tree[node_j], self.tree[node_i]
-        self.dict[self.tree[node_i].index], self.dict[self.tree[node_j].index] = node_i, node_j
+        """Swaps the tree nodes node_i and node_j and updates the positions appropriately"""
+        times, indices = self.times, self.indices
+        times[node_i], times[node_j] = times[node_j], times[node_i]
+        indices[node_i], indices[node_j] = indices[node_j], indices[node_i]
+        self.positions[indices[node_i]], self.positions[indices[node_j]] = node_i, node_j
+
+    def _sift_down(self, node_index):
+        times, size = self.times, len(self.times)
+        while True:
+            smallest = node_index
+            left = 2 * node_index + 1
+            right = 2 * node_index + 2
+
+            if left < size and times[left] < times[smallest]:
+                smallest = left
+            if right < size and times[right] < times[smallest]:
+                smallest = right
+
+            if smallest == node_index:
+                return
+            self._swap(smallest, node_index)
+            node_index = smallest
 
-    def update(self, ipq_node):
-        """Updates the indexed priority queue"""
-        self.tree[self.dict[ipq_node.index]] = ipq_node
-        self._update_aux(self.dict[ipq_node.index])
+    def update(self, index, time):
+        """Updates in place the putative time of the reaction `index`, and restores the heap property"""
+        times, size = self.times, len(self.times)
+        node_index = self.positions[index]
+        times[node_index] = time
 
-    def _update_aux(self, node_index):
+        # Move the node up while it's smaller than its parent...
         parent = (node_index - 1) // 2
-        left = 2 * node_index + 1
-        right = 2 * node_index + 2
+        if node_index > 0 and time < times[parent]:
+            while node_index > 0 and time < times[parent]:
+                self._swap(node_index, parent)
+                node_index, parent = parent, (parent - 1) // 2
+            return
 
-        if left < len(self.tree):
+        # ...otherwise move it down while it's greater than its smallest child.
+        while True:
+            left = 2 * node_index + 1
+            if left >= size:
+                return
             min_child = left
-        if right < len(self.tree) and self.tree[min_child].time > self.tree[right].time:
-            min_child = right
-
-        if parent >= 0 and self.tree[node_index].time < self.tree[parent].time:
-            self._swap(node_index, parent)
-            self._update_aux(parent)
-        elif left < len(self.tree) and self.tree[node_index].time > self.tree[min_child].time:
+            if left + 1 < size and times[left] > times[left + 1]:
+                min_child = left + 1
+            if time <= times[min_child]:
+                return
             self._swap(node_index, min_child)
-            self._update_aux(min_child)
-        else:
-            return
+            node_index = min_child
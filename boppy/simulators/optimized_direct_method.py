@@ -0,0 +1,55 @@
+import numpy as np
+
+import boppy.core
+from .ssa import PartialSumTree
+from ..utils.trajectory import TrajectoryBuffer
+
+
+def optimized_direct_method(update_matrix, initial_conditions, function_rates, t_max, **kwargs):
+    """
+    This function implements the Optimized Direct Method from Cao, Li and Petzold.
+
+    After a reaction fires, only the rates of the reactions depending on it (according to the
+    dependency graph) are recomputed, and the total rate is kept updated in a tree of partial sums.
+
+    See `RateFunctionCollection.update_rates` for the requirements on `function_rates` and on the
+    `depends_on` secondary argument.
+
+    References:
+    Y. Cao, H. Li and L. Petzold "Efficient formulation of the stochastic simulation algorithm for
+    chemically reacting systems", The Journal of Chemical Physics, 2004, 121 (9), 4059-4067
+    """
+    dependency_graph = boppy.core.DependencyGraph(kwargs['affects'], kwargs['depends_on'])
+
+    states = np.copy(initial_conditions)
+    rates = np.array(function_rates(states), dtype=float)
+    rates_tree = PartialSumTree(rates)
+
+    trajectory = TrajectoryBuffer(states.shape[0])
+    trajectory.append(0, states)
+
+    simul_t = 0
+    while simul_t < t_max:
+        total_rate = rates_tree.total
+        if total_rate <= 0:
+            # No reaction can fire anymore: the state won't change until t_max.
+            break
+
+        # Random numbers are drawn as in `ssa.SSA`, so that the two methods are interchangeable.
+        rnd_react = np.random.uniform(0.0001, total_rate)
+        rnd_time = np.random.uniform(0.0001, 1)
+
+        simul_t = - np.log(rnd_time) / total_rate + simul_t
+
+        reaction = rates_tree.search(rnd_react)
+        states += update_matrix[reaction, :]
+
+        # Only the rates of the reactions affected by the one executed can change.
+        dependent_reactions = dependency_graph[reaction]
+        function_rates.update_rates(states, dependent_reactions, rates)
+        for reaction_index in dependent_reactions:
+            rates_tree.update(reaction_index, rates[reaction_index])
+
+        trajectory.append(simul_t, states)
+
+    return trajectory.to_array()
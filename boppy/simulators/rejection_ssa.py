@@ -0,0 +1,128 @@
+import itertools
+import logging
+import numpy as np
+
+import boppy.core
+from .ssa import PartialSumTree
+from ..utils.trajectory import TrajectoryBuffer
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _fluctuation_intervals(states, delta):
+    """Each species can fluctuate of a fraction `delta` of its value (and at least of one unit)."""
+    widths = np.maximum(delta * states, 1)
+    return np.maximum(states - widths, 0), states + widths
+
+
+def _box_corners(depends_on):
+    """For each rate, a (corners x species) mask choosing the upper end of each interval."""
+    return [np.array(list(itertools.product((False, True), repeat=len(species))), dtype=bool)
+            for species in depends_on]
+
+
+def _bound_rates(function_rates, depends_on, corners, lower_states, upper_states, reactions,
+                 lower_rates, upper_rates):
+    """Bound the rates in positions `reactions` over the box of the fluctuation intervals.
+
+    Each rate is evaluated on all the corners of the box, in the species it depends on: the
+    minimum and maximum are bounds if the rate is monotone in each species, even in different
+    directions.
+    """
+    for reaction in reactions:
+        species = np.asarray(depends_on[reaction], dtype=int)
+        corner_states = np.repeat(lower_states[:, np.newaxis], corners[reaction].shape[0], axis=1)
+        corner_states[species] = np.where(corners[reaction].T, upper_states[species, np.newaxis],
+                                          lower_states[species, np.newaxis])
+        values = function_rates[reaction](corner_states)
+        lower_rates[reaction], upper_rates[reaction] = np.min(values), np.max(values)
+
+
+def rejection_ssa(update_matrix, initial_conditions, function_rates, t_max, **kwargs):
+    """
+    This function implements the Rejection-based SSA (RSSA) from Thanh, Priami and Zunino.
+
+    Each species is kept inside a fluctuation interval [x_low, x_up], and for each reaction a lower
+    and an upper bound of its rate over the intervals are precomputed, by evaluating the rate on
+    the corners of the box of the intervals (so the rates are assumed monotone in each species
+    separately; an InputError is raised when an exact rate turns out to be out of its bounds).
+    A candidate reaction is selected according to the upper bounds and accepted with probability
+    rate / upper bound: the exact rate is computed only when the lower bound isn't enough to
+    accept the candidate. Bounds are recomputed only for the reactions depending on species that
+    left their interval.
+
+    See `RateFunctionCollection.update_rates` for the requirements on `function_rates` and on the
+    `depends_on` secondary argument. Optional secondary argument: `delta`, the relative width of
+    the fluctuation intervals.
+
+    References:
+    V.H. Thanh, C. Priami and R. Zunino "Efficient rejection-based simulation of biochemical
+    reactions with stochastic noise and delays", The Journal of Chemical Physics, 2014,
+    141 (13), 134116
+    """
+    delta = kwargs.get("delta", 0.1)
+
+    states = np.array(initial_conditions, dtype=float)
+    num_species, num_reactions = states.shape[0], update_matrix.shape[0]
+
+    # Reactions whose rate has to be bounded again when a species leaves its interval.
+    depends_on = kwargs['depends_on']
+    species_graph = boppy.core.DependencyGraph([[species] for species in range(num_species)],
+                                               depends_on)
+    corners = _box_corners(depends_on)
+
+    lower_states, upper_states = _fluctuation_intervals(states, delta)
+    lower_rates, upper_rates = np.empty(num_reactions), np.empty(num_reactions)
+    _bound_rates(function_rates, depends_on, corners, lower_states, upper_states,
+                 range(num_reactions), lower_rates, upper_rates)
+    upper_rates_tree = PartialSumTree(upper_rates)
+    exact_rate = np.empty(num_reactions)
+
+    trajectory = TrajectoryBuffer(num_species)
+    trajectory.append(0, states)
+
+    simul_t = 0
+    num_trials = num_evaluations = 0
+    while simul_t < t_max:
+        total_upper_rate = upper_rates_tree.total
+        if total_upper_rate <= 0:
+            break
+
+        # Every trial, even a rejected one, makes the time advance.
+        while True:
+            num_trials += 1
+            simul_t -= np.log(1 - np.random.random_sample()) / total_upper_rate
+            candidate = upper_rates_tree.search((1 - np.random.random_sample()) * total_upper_rate)
+            acceptance = np.random.random_sample() * upper_rates[candidate]
+
+            if acceptance <= lower_rates[candidate]:
+                break
+            num_evaluations += 1
+            function_rates.update_rates(states, (candidate,), exact_rate)
+            if exact_rate[candidate] > upper_rates[candidate] * (1 + 1e-12) or \
+                    exact_rate[candidate] < lower_rates[candidate] * (1 - 1e-12):
+                raise boppy.core.InputError(
+                    "The rate of reaction {} ({}) is out of its bounds [{}, {}]: RSSA requires "
+                    "rates monotone in each species.".format(candidate, exact_rate[candidate],
+                                                             lower_rates[candidate],
+                                                             upper_rates[candidate]))
+            if acceptance <= exact_rate[candidate]:
+                break
+
+        states += update_matrix[candidate, :]
+        trajectory.append(simul_t, states)
+
+        outside = np.flatnonzero((states < lower_states) | (states > upper_states))
+        if outside.shape[0] > 0:
+            lower_states[outside], upper_states[outside] = _fluctuation_intervals(states[outside],
+                                                                                  delta)
+            to_bound = np.unique(np.concatenate([species_graph[species] for species in outside]))
+            _bound_rates(function_rates, depends_on, corners, lower_states, upper_states,
+                         to_bound.tolist(), lower_rates, upper_rates)
+            for reaction_index in to_bound.tolist():
+                upper_rates_tree.update(reaction_index, upper_rates[reaction_index])
+
+    _LOGGER.info("RSSA performed %d exact rate evaluations over %d trials (%d reactions fired).",
+                 num_evaluations, num_trials, len(trajectory) - 1)
+
+    return trajectory.to_array()
@@ -0,0 +1,103 @@
+"""Forward sensitivities of the fluid approximation with respect to the parameters.
+
+The drift f(x, theta) of the fluid limit is symbolic, so the sensitivities s = dx/dtheta can be
+derived exactly: they follow the linear equations
+
+    ds/dt = J_x(x, theta) s + df/dtheta(x, theta),    s(0) = 0,
+
+which are integrated together with the states, in a single augmented system. With P parameters
+the gradients are obtained with one solve, instead of the 2P + 1 of central finite differences.
+"""
+
+import numpy as np
+import sympy as sym
+
+from boppy.core import ParameterCollection, RateFunction
+from .fluid_approximation import CompiledDrift, integrate, _reduced_equations
+
+
+def sensitivity_equations(equations, states_symbols, parameters_symbols):
+    """Augment `equations` with the forward sensitivity equations of the states.
+
+    Returns the augmented equations, and the symbols of the states followed by the symbols of the
+    sensitivities, ordered by species and then by parameter.
+    """
+    drift = sym.Matrix(equations)
+    sensitivities = sym.Matrix(len(states_symbols), len(parameters_symbols),
+                               lambda i, p: sym.Symbol("s_{}_{}".format(states_symbols[i],
+                                                                        parameters_symbols[p])))
+    sensitivities_drift = (drift.jacobian(sym.Matrix(states_symbols)) * sensitivities +
+                           drift.jacobian(sym.Matrix(parameters_symbols)))
+
+    return (list(equations) + list(sensitivities_drift),
+            list(states_symbols) + list(sensitivities))
+
+
+def fluid_sensitivities(update_matrix, initial_conditions, function_rates, t_max, **kwargs):
+    """
+    Fluid approximation of the densities, with their sensitivities w.r.t. the parameters.
+
+    Secondary arguments: the same of `fluid_approximation`, plus `parameters`, the
+    ParameterCollection with the values of the parameters, and optionally
+    `sensitivity_parameters`, the names of the parameters to derive (all of them by default).
+    The sensitivities are derived from the rate functions before the substitution of the
+    parameters values, `RateFunction.sym_function_with_params`.
+
+    Returns the times and densities array, as `fluid_approximation` does, and the sensitivities as
+    a (times x species x parameters) array.
+    """
+    rate_funcs_N = kwargs["rate_functions_var_ss"]
+    variables = kwargs["variables"]
+    system_size = kwargs["system_size"]
+    parameters = kwargs["parameters"]
+    sensitivity_parameters = kwargs.get("sensitivity_parameters") or list(parameters.keys())
+
+    d_initial_conditions = np.asarray(initial_conditions, dtype=float) / system_size.value
+    laws, totals, equations, d_symbols = _reduced_equations(
+        update_matrix, d_initial_conditions,
+        [rate_func.sym_function_with_params for rate_func in rate_funcs_N], variables,
+        system_size)
+
+    parameters_symbols = [parameters[name].symbol for name in sensitivity_parameters]
+    augmented_equations, augmented_symbols = sensitivity_equations(equations, d_symbols,
+                                                                   parameters_symbols)
+    parameters_values = {param.symbol: param.value for param in parameters.values()}
+    compiled_drift = CompiledDrift([equation.subs(parameters_values)
+                                    for equation in augmented_equations], augmented_symbols)
+
+    # The initial conditions don't depend on the parameters.
+    num_independent = len(d_symbols)
+    initial_augmented = np.zeros(len(augmented_symbols))
+    initial_augmented[:num_independent] = d_initial_conditions[laws.independent]
+
+    t = np.linspace(0, t_max, 1000)
+    solution = integrate(compiled_drift, initial_augmented, t, kwargs.get("ode_solver"))
+
+    states = laws.reconstruct(solution[:, :num_independent], totals)
+    # The conserved totals don't depend on the parameters, so the dependent species follow the
+    # independent ones through the reconstruction matrix only.
+    sensitivities = np.matmul(laws.reconstruction_matrix,
+                              solution[:, num_independent:].reshape(t.shape[0], num_independent,
+                                                                    len(parameters_symbols)))
+
+    return np.c_[t, states], sensitivities
+
+
+def output_gradients(outputs, variables, states, sensitivities):
+    """Gradients w.r.t. the parameters of functions of the states, e.g. "x_i + x_r".
+
+    `states` and `sensitivities` are the ones returned by `fluid_sensitivities` (without the
+    times column); the outputs are strings in the same syntax of the rate functions, in the
+    variables of the model, which are evaluated on the densities.
+
+    Returns a (times x outputs x parameters) array.
+    """
+    variables_symbols = [var.symbol for var in variables.values()]
+    output_functions = [RateFunction(output, variables, ParameterCollection({})).sym_function
+                        for output in outputs]
+    # Gradients of the outputs w.r.t. the states, on each time: (times x outputs x species).
+    gradients = sym.lambdify(variables_symbols,
+                             sym.Matrix(output_functions).jacobian(sym.Matrix(variables_symbols)),
+                             "numpy")
+    states_gradients = np.array([np.array(gradients(*state), dtype=float) for state in states])
+    return np.matmul(states_gradients, sensitivities)
@@ -0,0 +1,229 @@
+import logging
+import numpy as np
+
+from ..utils.trajectory import TrajectoryBuffer
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _virtual_fast_distribution(direction, states, function_rates, forward, backward):
+    """Stationary distribution of the virtual fast process of a reversible pair.
+
+    Only the pair fires in the virtual fast process, so the states reachable are the ones on the
+    line `states + n * direction` with non negative populations. It's a birth-death process on n,
+    so the stationary probabilities satisfy pi(n + 1) / pi(n) = a_forward(n) / a_backward(n + 1).
+
+    Returns the reachable states (positions x species), the values of n and their probabilities.
+    """
+    with np.errstate(divide='ignore'):
+        bounds = -states / direction
+    n_min = int(np.max(np.ceil(bounds[direction > 0])))
+    n_max = int(np.min(np.floor(bounds[direction < 0])))
+    steps = np.arange(n_min, n_max + 1)
+
+    grid = states + steps[:, np.newaxis] * direction
+    rates = np.maximum(np.asarray(function_rates(grid.T), dtype=float), 0)
+
+    with np.errstate(divide='ignore'):
+        log_ratios = (np.log(rates[forward, :-1]) -
+                      np.log(np.maximum(rates[backward, 1:], np.finfo(float).tiny)))
+    log_probabilities = np.concatenate(([0], np.cumsum(log_ratios)))
+    probabilities = np.exp(log_probabilities - np.max(log_probabilities))
+    return grid, steps, probabilities / probabilities.sum()
+
+
+class _FastSubsystem:
+    """Stationary distribution of a fast reversible pair, cached between slow reactions.
+
+    The distribution is stored relative to the current state: when the pair relaxes to another
+    position, it's only shifted. It's computed again only after a slow reaction changes the
+    species moved by the pair or the ones its rates depend on, and always when the rates depend
+    on species moved by another pair. The rates of the slow reactions depending on the pair,
+    averaged over the distribution, are cached as well.
+    """
+
+    def __init__(self, update_matrix, pair, dependents, depends_on):
+        self.forward, self.backward = pair
+        self.direction = update_matrix[self.forward]
+        self.dependents = dependents
+
+        num_species = update_matrix.shape[1]
+        self.fast_rates_species = np.zeros(num_species, dtype=bool)
+        self.fast_rates_species[np.concatenate([np.asarray(depends_on[reaction], dtype=int)
+                                                for reaction in pair])] = True
+        self.fast_species = self.fast_rates_species | (self.direction != 0)
+        self.dependents_species = np.zeros(num_species, dtype=bool)
+        self.dependents_species[np.concatenate(
+            [np.asarray(depends_on[reaction], dtype=int) for reaction in dependents] +
+            [np.empty(0, dtype=int)])] = True
+        self.coupled = False
+
+        self.steps = self.probabilities = self.dependents_rates = None
+        self._cumulative, self.mean_step = None, 0.
+        self.num_computed = 0
+
+    def update(self, states, function_rates):
+        if self.steps is None or self.coupled:
+            _, self.steps, self.probabilities = _virtual_fast_distribution(
+                self.direction, states, function_rates, self.forward, self.backward)
+            self._cumulative = np.cumsum(self.probabilities)
+            self.mean_step = self.steps.dot(self.probabilities)
+            self.dependents_rates = None
+            self.num_computed += 1
+
+    def averaged_dependents_rates(self, mean_states, function_rates):
+        """Rates of the dependent slow reactions averaged over the distribution, with the other
+        pairs in their mean position."""
+        if self.dependents_rates is None:
+            grid = mean_states + (self.steps - self.mean_step)[:, np.newaxis] * self.direction
+            self.dependents_rates = np.asarray(function_rates(grid.T),
+                                               dtype=float)[self.dependents].dot(self.probabilities)
+        return self.dependents_rates
+
+    def relax(self):
+        """Sample the position of the pair; return the change of the state."""
+        position = min(np.searchsorted(self._cumulative,
+                                       (1 - np.random.random_sample()) * self._cumulative[-1]),
+                       self.steps.shape[0] - 1)
+        step = self.steps[position]
+        self.steps = self.steps - step
+        self.mean_step -= step
+        return step * self.direction
+
+    def invalidate(self, changed_species):
+        if np.any(changed_species & self.fast_species):
+            self.steps = None
+        elif np.any(changed_species & self.dependents_species):
+            self.dependents_rates = None
+
+
+def find_fast_reversible_pairs(update_matrix, states, function_rates, fast_ratio=100):
+    """Find the pairs of reactions (j, k), with j < k, that form fast reversible subsystems.
+
+    Two reactions are a reversible pair when their update vectors are opposite, and the direction
+    both consumes and produces species, so that the pair alone keeps the populations bounded.
+    A pair is fast when, at the equilibrium of its virtual fast process, its expected rate is at
+    least `fast_ratio` times the highest rate of the reactions outside the pairs. Pairs changing
+    the same species of an already selected faster pair are discarded, so that each fast
+    subsystem can be solved independently of the others.
+    """
+    num_reactions = update_matrix.shape[0]
+    candidates = [(j, k) for j in range(num_reactions) for k in range(j + 1, num_reactions)
+                  if np.any(update_matrix[j] > 0) and np.any(update_matrix[j] < 0) and
+                  np.array_equal(update_matrix[j], -update_matrix[k])]
+
+    in_pairs = np.zeros(num_reactions, dtype=bool)
+    in_pairs[[reaction for pair in candidates for reaction in pair]] = True
+    rates = np.asarray(function_rates(states), dtype=float)
+    slow_max_rate = np.max(rates[~in_pairs], initial=0)
+
+    # At equilibrium the forward and backward expected rates are the same.
+    equilibrium_rates = []
+    for j, k in candidates:
+        grid, _, probabilities = _virtual_fast_distribution(update_matrix[j], states,
+                                                            function_rates, j, k)
+        equilibrium_rates.append(np.asarray(function_rates(grid.T),
+                                            dtype=float)[j].dot(probabilities))
+
+    fast_pairs, used_species = [], np.zeros(update_matrix.shape[1], dtype=bool)
+    for equilibrium_rate, (j, k) in sorted(zip(equilibrium_rates, candidates), reverse=True):
+        changed = update_matrix[j] != 0
+        if equilibrium_rate > 0 and equilibrium_rate >= fast_ratio * slow_max_rate and \
+                not np.any(used_species & changed):
+            fast_pairs.append((j, k))
+            used_species |= changed
+    return fast_pairs
+
+
+def slow_scale_ssa(update_matrix, initial_conditions, function_rates, t_max, **kwargs):
+    """
+    Slow-scale SSA from Cao, Gillespie and Petzold.
+
+    Fast reversible pairs of reactions (see `find_fast_reversible_pairs`) are detected on the
+    initial conditions, and are never simulated: only the slow reactions fire, with effective
+    rates averaged over the stationary distribution of the virtual fast process, which is
+    computed exactly for each pair, and again only when a slow reaction changes its species (see
+    `_FastSubsystem`). Before each slow reaction fires, the position of each fast subsystem is
+    sampled from its stationary distribution.
+
+    Slow rates depending on species of more than one fast pair are averaged over one pair at a
+    time, with the other ones in their mean position.
+
+    `function_rates` must accept a 2D array of shape (species, points), as
+    RateFunctionCollection does. Secondary arguments: `depends_on`, and optionally the
+    `fast_ratio` used to detect the fast pairs.
+
+    References:
+    Y. Cao, D.T. Gillespie and L.R. Petzold "The slow-scale stochastic simulation algorithm",
+    The Journal of Chemical Physics, 2005, 122 (1), 014116
+    """
+    depends_on = kwargs["depends_on"]
+    fast_ratio = kwargs.get("fast_ratio", 100)
+
+    states = np.array(initial_conditions, dtype=float)
+    num_reactions = update_matrix.shape[0]
+
+    fast_pairs = find_fast_reversible_pairs(update_matrix, states, function_rates, fast_ratio)
+    slow = np.ones(num_reactions, dtype=bool)
+    slow[[reaction for pair in fast_pairs for reaction in pair]] = False
+    slow_reactions = np.flatnonzero(slow)
+
+    # Slow reactions whose rate depends on the species changed by each fast pair.
+    subsystems = [_FastSubsystem(update_matrix, (j, k),
+                                 np.array([reaction for reaction in slow_reactions
+                                           if np.any(update_matrix[j][np.asarray(
+                                               depends_on[reaction], dtype=int)] != 0)],
+                                          dtype=int),
+                                 depends_on)
+                  for j, k in fast_pairs]
+    for subsystem in subsystems:
+        subsystem.coupled = any(np.any(other.direction[subsystem.fast_rates_species] != 0)
+                                for other in subsystems if other is not subsystem)
+
+    trajectory = TrajectoryBuffer(states.shape[0])
+    trajectory.append(0, states)
+
+    simul_t = 0
+    while simul_t < t_max:
+        for subsystem in subsystems:
+            subsystem.update(states, function_rates)
+
+        mean_states = states + sum((subsystem.direction * subsystem.mean_step
+                                    for subsystem in subsystems), np.zeros_like(states))
+        effective_rates = np.array(function_rates(mean_states), dtype=float)
+        for subsystem in subsystems:
+            if subsystem.dependents.shape[0] > 0:
+                effective_rates[subsystem.dependents] = subsystem.averaged_dependents_rates(
+                    mean_states, function_rates)
+
+        slow_rates = np.maximum(np.where(slow, effective_rates, 0), 0)
+        cumulative_rates = np.cumsum(slow_rates)
+        if cumulative_rates[-1] <= 0:
+            break
+
+        simul_t -= np.log(1 - np.random.random_sample()) / cumulative_rates[-1]
+        rnd_react = (1 - np.random.random_sample()) * cumulative_rates[-1]
+        reaction = min(np.searchsorted(cumulative_rates, rnd_react), num_reactions - 1)
+
+        # The fast subsystems are relaxed to their stationary distribution in the meantime.
+        for subsystem in subsystems:
+            states += subsystem.relax()
+        states += update_matrix[reaction]
+        trajectory.append(simul_t, states)
+
+        changed_species = update_matrix[reaction] != 0
+        for subsystem in subsystems:
+            subsystem.invalidate(changed_species)
+        # A pair computed again moves its mean, which the slow rates of the others depend on.
+        for subsystem in subsystems:
+            if subsystem.steps is None or subsystem.coupled:
+                for other in subsystems:
+                    if other is not subsystem:
+                        other.invalidate(subsystem.direction != 0)
+
+    _LOGGER.info("Slow-scale SSA: %d fast reversible pairs %s removed, %d of %d reactions "
+                 "simulated, %d slow reactions fired, %d fast distributions computed.",
+                 len(fast_pairs), fast_pairs, slow_reactions.shape[0], num_reactions,
+                 len(trajectory) - 1, sum(subsystem.num_computed for subsystem in subsystems))
+
+    return trajectory.to_array()
@@ -0,0 +1,87 @@
+import logging
+import numpy as np
+
+import boppy.core
+from ..utils.trajectory import TrajectoryBuffer
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def sorting_direct_method(update_matrix, initial_conditions, function_rates, t_max, **kwargs):
+    """
+    This function implements the Sorting Direct Method from McCollum, Peterson, Cox, Simpson and
+    Samatova.
+
+    The reaction is selected with a linear search over the rates, performed in an order that is
+    adapted during the simulation: every time a reaction fires, it's swapped with the one preceding
+    it in the search order, so that the reactions firing most often bubble up to the first
+    positions. Only the rates of the reactions depending on the one executed are recomputed, and
+    the total rate is kept updated.
+
+    The final search order and the number of firings of each reaction are logged at INFO level.
+
+    See `RateFunctionCollection.update_rates` for the requirements on `function_rates` and on the
+    `depends_on` secondary argument.
+
+    References:
+    J.M. McCollum, G.D. Peterson, C.D. Cox, M.L. Simpson and N.F. Samatova "The sorting direct
+    method for stochastic simulation of biochemical systems with varying reaction execution
+    behavior", Computational Biology and Chemistry, 2006, 30 (1), 39-49
+    """
+    dependency_graph = boppy.core.DependencyGraph(kwargs['affects'], kwargs['depends_on'])
+
+    states = np.copy(initial_conditions)
+    rates = np.array(function_rates(states), dtype=float)
+    num_reactions = rates.shape[0]
+
+    # Start searching from the reactions that are initially the fastest.
+    search_order = [int(reaction) for reaction in np.argsort(-rates, kind="mergesort")]
+    rates_list = rates.tolist()
+    firings = [0] * num_reactions
+
+    trajectory = TrajectoryBuffer(states.shape[0])
+    trajectory.append(0, states)
+
+    total_rate = sum(rates_list)
+    simul_t = num_steps = 0
+    while simul_t < t_max:
+        if total_rate <= 0:
+            break
+
+        simul_t -= np.log(1 - np.random.random_sample()) / total_rate
+        rnd_react = (1 - np.random.random_sample()) * total_rate
+
+        for position, reaction in enumerate(search_order):
+            rnd_react -= rates_list[reaction]
+            if rnd_react <= 0 and rates_list[reaction] > 0:
+                break
+        else:
+            # Rounding errors in the total rate: pick the last reaction that can fire.
+            position = max(pos for pos, reac in enumerate(search_order) if rates_list[reac] > 0)
+            reaction = search_order[position]
+
+        # Let the reaction just executed move one step towards the head of the search order.
+        if position > 0:
+            search_order[position - 1], search_order[position] = (search_order[position],
+                                                                  search_order[position - 1])
+        firings[reaction] += 1
+
+        states += update_matrix[reaction, :]
+
+        dependent_reactions = dependency_graph[reaction]
+        function_rates.update_rates(states, dependent_reactions, rates)
+        for reaction_index in dependent_reactions.tolist():
+            total_rate += rates[reaction_index] - rates_list[reaction_index]
+            rates_list[reaction_index] = float(rates[reaction_index])
+
+        # Sum the rates again from time to time, to avoid the accumulation of rounding errors.
+        num_steps += 1
+        if num_steps % num_reactions == 0:
+            total_rate = sum(rates_list)
+
+        trajectory.append(simul_t, states)
+
+    _LOGGER.info("Sorting direct method final search order: %s; firings per reaction: %s",
+                 search_order, firings)
+
+    return trajectory.to_array()
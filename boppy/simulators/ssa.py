@@ -1,6 +1,7 @@
-from copy import deepcopy
 import numpy as np
 
+from ..utils.trajectory import TrajectoryBuffer
+
 
 def _initialize_vector_binary_search(vector):
     """Generate a new vector of lenght (2 * m - 1), where m is the lenght of the input vector and
@@ -30,35 +31,71 @@ def _binary_search_processing(vector, random_value):
     return i - cut_value
 
 
+class PartialSumTree:
+    """Persistent version of the vector produced by `_initialize_vector_binary_search`.
+
+    When a rate changes, only the partial sums on the path from its leaf to the root are
+    recomputed, so each update costs O(log m) instead of rebuilding the whole vector.
+    """
+
+    def __init__(self, vector):
+        self.tree = _initialize_vector_binary_search(np.asarray(vector, dtype=float))
+        self._leaves_start = self.tree.shape[0] // 2
+
+    @property
+    def total(self):
+        return self.tree[0]
+
+    @property
+    def leaves(self):
+        return self.tree[self._leaves_start:]
+
+    def update(self, index, value):
+        """Set the value of the `index`-th leaf, then fix the partial sums of its ancestors."""
+        tree = self.tree
+        node = self._leaves_start + index
+        tree[node] = value
+        while node > 0:
+            node = (node - 1) // 2
+            tree[node] = tree[2 * node + 1] + tree[2 * node + 2]
+
+    def update_changed(self, vector):
+        """Update only the leaves whose value differs from the one in `vector`."""
+        for index in np.flatnonzero(self.leaves != vector):
+            self.update(index, vector[index])
+
+    def search(self, random_value):
+        return _binary_search_processing(self.tree, random_value)
+
+
 def SSA(update_matrix, initial_conditions, function_rates, t_max, **kwargs):  # noqa
     """Stochastic Simulation Algorithm."""
-    # vector of number of reaction for each times
-    data_vector = [deepcopy(initial_conditions)]
-    time_vector = [0]
-    previous_states = deepcopy(initial_conditions)
+    previous_states = np.copy(initial_conditions)
 
-    i = simul_t = 0
+    # Times and states are stored together, in the same layout of the array returned.
+    trajectory = TrajectoryBuffer(previous_states.shape[0])
+    trajectory.append(0, previous_states)
+
+    # The tree of partial sums of rates is kept between steps, and only the rates changed by the
+    # last reaction are updated.
+    rates_tree = PartialSumTree(function_rates(previous_states))
+
+    simul_t = 0
     while simul_t < t_max:
-        rates = function_rates(previous_states)
-        total_rate = sum(rates)
+        rates_tree.update_changed(function_rates(previous_states))
+        total_rate = rates_tree.total
 
         # Generate two random numbers: one to select the reaction, the other for the execution time.
         rnd_react = np.random.uniform(0.0001, total_rate)
         rnd_time = np.random.uniform(0.0001, 1)
 
-        simul_t = - np.log(rnd_time) / total_rate + time_vector[i]
+        simul_t = - np.log(rnd_time) / total_rate + simul_t
 
         # choose reaction and update the vector of reactions
-        vector_binary = _initialize_vector_binary_search(rates)
-        reaction = _binary_search_processing(vector_binary, rnd_react)
+        reaction = rates_tree.search(rnd_react)
 
         previous_states += update_matrix[reaction, :]
 
-        # update the data_vector and time_vector
-        time_vector.append(simul_t)
-        data_vector.append(deepcopy(previous_states))
-
-        i += 1
+        trajectory.append(simul_t, previous_states)
 
-    # Pack together the time column with the states associated to it.
-    return np.c_[time_vector, data_vector]
+    return trajectory.to_array()
@@ -0,0 +1,64 @@
+"""Run the Stochastic Simulation Algorithm on a whole ensemble of trajectories at once.
+
+This is the CPU counterpart of `gpu/ssa_gpu.py`: instead of assigning one iteration to each thread,
+the states of all the iterations are stored in a (iterations x species) array, and every step of
+the algorithm is performed on all the trajectories still running with vectorized numpy operations.
+
+Trajectories that exceed the maximum time (or reach a state where no reaction can fire) are masked
+out, so that the following steps are only computed on the ones still active.
+"""
+
+import numpy as np
+
+
+def SSA(update_matrix, initial_conditions, function_rates, t_max, **kwargs):  # noqa
+    """Lockstep Stochastic Simulation Algorithm over `kwargs["iterations"]` trajectories.
+
+    `function_rates` must accept a 2D array of shape (species, trajectories) and return an array
+    of shape (reactions, trajectories), as RateFunctionCollection does.
+
+    Returns a list with a (time + states) 2D array for each trajectory, as the CPU controller does.
+    """
+    iterations = kwargs["iterations"]
+    num_reactions = update_matrix.shape[0]
+
+    states = np.tile(np.asarray(initial_conditions, dtype=float), (iterations, 1))
+    times = np.zeros(iterations)
+    active = np.arange(iterations)
+
+    # For each step store which trajectories were updated, and their new times and states.
+    recorded_indices, recorded_times, recorded_states = [active], [times.copy()], [states.copy()]
+
+    while active.shape[0] > 0:
+        rates = function_rates(states[active].T)
+        cumulative_rates = np.cumsum(rates, axis=0)
+        total_rate = cumulative_rates[-1]
+        can_fire = total_rate > 0
+
+        # Use (0, 1] random values, so that reactions with zero rate are never selected.
+        rnd_react = (1 - np.random.random_sample(active.shape[0])) * total_rate
+        rnd_time = 1 - np.random.random_sample(active.shape[0])
+
+        # Select, for each trajectory, the first reaction whose cumulative rate reaches rnd_react.
+        reaction = np.minimum((cumulative_rates < rnd_react).sum(axis=0), num_reactions - 1)
+
+        # Trajectories where nothing can fire anymore are simply dropped.
+        active, reaction = active[can_fire], reaction[can_fire]
+        new_times = times[active] - np.log(rnd_time[can_fire]) / total_rate[can_fire]
+
+        states[active] += update_matrix[reaction]
+        times[active] = new_times
+
+        recorded_indices.append(active)
+        recorded_times.append(new_times)
+        recorded_states.append(states[active])
+
+        active = active[new_times < t_max]
+
+    all_indices = np.concatenate(recorded_indices)
+    # A stable sort keeps the events of each trajectory in chronological order.
+    order = np.argsort(all_indices, kind="mergesort")
+    times_and_states = np.c_[np.concatenate(recorded_times), np.concatenate(recorded_states)][order]
+
+    split_points = np.cumsum(np.bincount(all_indices, minlength=iterations))[:-1]
+    return np.split(times_and_states, split_points)
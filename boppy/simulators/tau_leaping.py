@@ -0,0 +1,139 @@
+import numpy as np
+
+from ..utils.trajectory import TrajectoryBuffer
+
+
+def _species_g_factors(reagents_matrix, states):
+    """Compute the `g_i` factors of the step size selection for each species.
+
+    g_i depends on the highest order of the reactions where species i appears as reagent, and on
+    how many molecules of i those reactions consume.
+    """
+    orders = reagents_matrix.sum(axis=1)[:, np.newaxis] * np.ones_like(reagents_matrix)
+    copies = reagents_matrix
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_1 = 1 / (states - 1)
+        x_2 = 2 / (states - 2)
+        g_factors = np.where(orders <= 1, 1., orders)
+        g_factors = np.where((orders == 2) & (copies == 2), 2 + x_1, g_factors)
+        g_factors = np.where((orders == 3) & (copies == 2), 1.5 * (2 + x_1), g_factors)
+        g_factors = np.where((orders == 3) & (copies == 3), 3 + x_1 + x_2, g_factors)
+
+    # Only reactions where the species is a reagent contribute; small populations where the
+    # formulas above are undefined get an infinite factor, i.e. the smallest bound possible.
+    g_factors = np.where(copies > 0, g_factors, 0)
+    g_factors[~np.isfinite(g_factors)] = np.inf
+    return g_factors.max(axis=0)
+
+
+def _select_tau(update_matrix, reagents_matrix, states, rates, non_critical, epsilon):
+    """Cao-Gillespie-Petzold step size, computed only over the non-critical reactions."""
+    reagent_species = np.any(reagents_matrix > 0, axis=0)
+    if not np.any(non_critical) or not np.any(reagent_species):
+        return np.inf
+
+    non_critical_rates = np.where(non_critical, rates, 0)
+    mean_change = non_critical_rates.dot(update_matrix)[reagent_species]
+    variance_change = non_critical_rates.dot(update_matrix ** 2)[reagent_species]
+
+    g_factors = _species_g_factors(reagents_matrix, states)[reagent_species]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bounds = np.maximum(epsilon * states[reagent_species] / g_factors, 1)
+        return min(np.min(bounds / np.abs(mean_change)), np.min(bounds ** 2 / variance_change))
+
+
+def _ssa_steps(update_matrix, states, simul_t, function_rates, t_max, num_steps, trajectory):
+    """Perform up to `num_steps` exact direct method steps; return the time reached."""
+    for _ in range(num_steps):
+        rates = function_rates(states)
+        cumulative_rates = np.cumsum(rates)
+        if cumulative_rates[-1] <= 0:
+            return np.inf
+
+        simul_t -= np.log(1 - np.random.random_sample()) / cumulative_rates[-1]
+        rnd_react = (1 - np.random.random_sample()) * cumulative_rates[-1]
+        states += update_matrix[np.searchsorted(cumulative_rates, rnd_react)]
+        trajectory.append(simul_t, states)
+
+        if simul_t >= t_max:
+            break
+
+    return simul_t
+
+
+def tau_leaping(update_matrix, initial_conditions, function_rates, t_max, **kwargs):
+    """
+    Explicit tau-leaping, with the step size selection from Cao, Gillespie and Petzold.
+
+    At each step the number of firings of each reaction is drawn from a Poisson distribution.
+    Reactions that are within `critical_threshold` firings of exhausting one of their reagents
+    are "critical": at most one of them fires per leap, as in the SSA. Leaps producing negative
+    populations are rejected and retried with half the step; when the step becomes comparable to
+    the SSA one (fewer than `ssa_threshold` expected events), `ssa_steps` exact SSA steps are
+    performed instead.
+
+    Secondary arguments: `reagents`, the (reactions x species) matrix of molecules consumed by
+    each reaction, and optionally `epsilon`, `critical_threshold`, `ssa_threshold`, `ssa_steps`.
+
+    References:
+    Y. Cao, D.T. Gillespie and L.R. Petzold "Efficient step size selection for the tau-leaping
+    simulation method", The Journal of Chemical Physics, 2006, 124 (4), 044109
+    """
+    reagents_matrix = kwargs["reagents"]
+    epsilon = kwargs.get("epsilon", 0.03)
+    critical_threshold = kwargs.get("critical_threshold", 10)
+    ssa_threshold = kwargs.get("ssa_threshold", 10)
+    ssa_steps = kwargs.get("ssa_steps", 100)
+
+    states = np.array(initial_conditions, dtype=float)
+    consumed = np.maximum(-update_matrix, 0)
+    num_reactions = update_matrix.shape[0]
+
+    trajectory = TrajectoryBuffer(states.shape[0])
+    trajectory.append(0, states)
+
+    simul_t = 0
+    while simul_t < t_max:
+        rates = np.maximum(function_rates(states), 0)
+        total_rate = rates.sum()
+        if total_rate <= 0:
+            break
+
+        # Maximum number of times each reaction can fire before one of its reagents is exhausted.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            max_firings = np.where(consumed > 0, np.floor(states / consumed), np.inf).min(axis=1)
+        critical = (rates > 0) & (max_firings < critical_threshold)
+
+        tau_non_critical = _select_tau(update_matrix, reagents_matrix, states, rates,
+                                       ~critical, epsilon)
+
+        if tau_non_critical < ssa_threshold / total_rate:
+            simul_t = _ssa_steps(update_matrix, states, simul_t, function_rates, t_max,
+                                 ssa_steps, trajectory)
+            continue
+
+        critical_rates = np.where(critical, rates, 0)
+        total_critical_rate = critical_rates.sum()
+
+        while True:
+            tau_critical = (np.random.exponential(1 / total_critical_rate)
+                            if total_critical_rate > 0 else np.inf)
+            tau = min(tau_non_critical, tau_critical, t_max - simul_t)
+
+            firings = np.where(critical, 0, np.random.poisson(np.where(critical, 0, rates) * tau))
+            if tau == tau_critical:
+                cumulative_rates = np.cumsum(critical_rates)
+                rnd_react = (1 - np.random.random_sample()) * total_critical_rate
+                firings[min(np.searchsorted(cumulative_rates, rnd_react), num_reactions - 1)] += 1
+
+            new_states = states + firings.dot(update_matrix)
+            if np.all(new_states >= 0):
+                break
+            tau_non_critical /= 2
+
+        states = new_states
+        simul_t += tau
+        trajectory.append(simul_t, states)
+
+    return trajectory.to_array()
@@ -0,0 +1,283 @@
+import numpy as np
+
+
+class TrajectoryBuffer:
+    """Preallocated 2D array where (time, states) rows of a trajectory are stored one at a time.
+
+    When the buffer is full its capacity is multiplied by `growth_factor`, so that the number of
+    reallocations is logarithmic in the number of events stored.
+    """
+
+    def __init__(self, num_species, initial_capacity=1024, growth_factor=2):
+        self._data = np.empty((max(initial_capacity, 1), num_species + 1))
+        self._growth_factor = growth_factor
+        self._size = 0
+
+    def _grow(self):
+        new_data = np.empty((int(self._data.shape[0] * self._growth_factor) + 1,
+                             self._data.shape[1]))
+        new_data[:self._size] = self._data[:self._size]
+        self._data = new_data
+
+    def append(self, time, states):
+        if self._size == self._data.shape[0]:
+            self._grow()
+
+        row = self._data[self._size]
+        row[0] = time
+        row[1:] = states
+        self._size += 1
+
+    def __len__(self):
+        return self._size
+
+    def to_array(self):
+        """Return a view over the rows filled so far, with the time in the first column."""
+        return self._data[:self._size]
+
+
+class TrajectoryBatch:
+    """Collection of trajectories of different lengths, stored as a single contiguous array.
+
+    The rows (time, states...) of all the trajectories are concatenated in `data`, and the i-th
+    trajectory is `data[offsets[i]:offsets[i + 1]]`, as the rows of a CSR matrix: single
+    trajectories are returned as views, without copies, and the operations on the whole batch are
+    performed on `data` at once.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = np.asarray(data, dtype=float)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_list(cls, trajectories):
+        """Batch from a sequence of 2D arrays with the same number of columns."""
+        trajectories = list(trajectories)
+        if not trajectories:
+            return cls(np.empty((0, 1)), np.zeros(1))
+        lengths = [trajectory.shape[0] for trajectory in trajectories]
+        return cls(np.concatenate(trajectories), np.cumsum([0] + lengths))
+
+    @classmethod
+    def from_dense(cls, array, end_time=None):
+        """Batch from a 3D (trajectories x rows x columns) array, all the trajectories long the
+        same; the data is a view of the array when it's contiguous.
+
+        When `end_time` is given, each trajectory is cut after its first row with time >= end_time
+        and the rows following it, which a simulator may have left unwritten, are dropped.
+        """
+        array = np.asarray(array)
+        num_trajectories, length, num_columns = array.shape
+        if end_time is None:
+            return cls(array.reshape(num_trajectories * length, num_columns),
+                       np.arange(0, num_trajectories * length + 1, length))
+
+        # Compared in the precision of the array, e.g. the single precision of the GPU simulator.
+        reached = array[:, :, 0] >= array.dtype.type(end_time)
+        lengths = np.where(reached.any(axis=1), reached.argmax(axis=1) + 1, length)
+        written = np.arange(length) < lengths[:, np.newaxis]
+        return cls(array[written], np.concatenate(([0], np.cumsum(lengths))))
+
+    @classmethod
+    def concatenate(cls, batches):
+        """Batch with the trajectories of all the batches, one after the other."""
+        batches = list(batches)
+        if not batches:
+            return cls.from_list([])
+        lengths = np.concatenate([batch.lengths for batch in batches])
+        return cls(np.concatenate([batch.data for batch in batches]),
+                   np.concatenate(([0], np.cumsum(lengths))))
+
+    @classmethod
+    def load(cls, file):
+        with np.load(file) as archive:
+            return cls(archive["data"], archive["offsets"])
+
+    def save(self, file):
+        """Store the batch in the numpy `.npz` format, which `load` reads back."""
+        np.savez(file, data=self.data, offsets=self.offsets)
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError("trajectory index {} out of range".format(index))
+        index %= len(self)
+        return self.data[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def times(self):
+        return self.data[:, 0]
+
+    @property
+    def trajectory_indices(self):
+        """Index of the trajectory each row belongs to."""
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def time_window(self, t_start, t_end):
+        """New batch with the rows of each trajectory with time in [t_start, t_end]."""
+        inside = (self.times >= t_start) & (self.times <= t_end)
+        lengths = np.bincount(self.trajectory_indices[inside], minlength=len(self))
+        return TrajectoryBatch(self.data[inside], np.concatenate(([0], np.cumsum(lengths))))
+
+    def resample(self, times_grid):
+        """States of all the trajectories on the times of the grid, as piecewise constant functions.
+
+        The state at time t is the one after the last event with time <= t; before the first
+        event of a trajectory the states are NaN. The events and the grid points of all the
+        trajectories are sorted together by (trajectory, time), with the events first on equal
+        times, and the last event preceding each grid point is a running maximum of the positions
+        of the events in that order.
+
+        Returns a (trajectories x grid times x species) array.
+        """
+        times_grid = np.asarray(times_grid, dtype=float)
+        num_trajectories, num_species = len(self), self.data.shape[1] - 1
+        num_events, num_times = self.data.shape[0], times_grid.shape[0]
+        if num_events == 0:
+            return np.full((num_trajectories, num_times, num_species), np.nan)
+
+        trajectories = np.concatenate((self.trajectory_indices,
+                                       np.repeat(np.arange(num_trajectories), num_times)))
+        times = np.concatenate((self.times, np.tile(times_grid, num_trajectories)))
+        is_grid = np.arange(num_events + num_trajectories * num_times) >= num_events
+        order = np.lexsort((is_grid, times, trajectories))
+
+        # Grid points don't move the running maximum, which starts before the first event.
+        positions = np.where(is_grid, -1, np.arange(num_events + num_trajectories * num_times))
+        last_events = np.empty_like(positions)
+        last_events[order] = np.maximum.accumulate(positions[order])
+        last_events = last_events[num_events:].reshape(num_trajectories, num_times)
+
+        # The last event found belongs to a previous trajectory when t precedes the first event.
+        before_start = last_events < self.offsets[:-1, np.newaxis]
+        states = self.data[np.maximum(last_events, 0), 1:]
+        states[before_start] = np.nan
+        return states
+
+
+def shared_memory_available():
+    """Shared memory segments need the `multiprocessing.shared_memory` module, from Python 3.8."""
+    try:
+        from multiprocessing import shared_memory  # noqa
+    except ImportError:
+        return False
+    return True
+
+
+def _untrack_segment(segment):
+    """Stop the resource tracker of this process from destroying the segment when it ends.
+
+    The tracker registers the segment under the name with the leading slash, which SharedMemory
+    only keeps in the private `_name` attribute (Python 3.8 to 3.12; from 3.13 the segment can be
+    created with `track=False` instead).
+    """
+    from multiprocessing import resource_tracker
+
+    resource_tracker.unregister(segment._name, "shared_memory")
+
+
+def write_shared_trajectories(trajectories):
+    """Copy the trajectories, one after the other, into a new shared memory segment.
+
+    Returns the layout of the segment: its name, the length of each trajectory and the number of
+    columns. The segment is left to the process that reads it, which has to unlink it.
+    """
+    from multiprocessing import shared_memory
+
+    lengths = [trajectory.shape[0] for trajectory in trajectories]
+    num_columns = trajectories[0].shape[1]
+
+    segment = shared_memory.SharedMemory(create=True, size=sum(lengths) * num_columns * 8)
+    data = np.ndarray((sum(lengths), num_columns), dtype=float, buffer=segment.buf)
+    np.concatenate(trajectories, out=data)
+    del data
+
+    # Otherwise the segment is destroyed when this process ends.
+    _untrack_segment(segment)
+    segment.close()
+    return segment.name, lengths, num_columns
+
+
+class SharedTrajectories:
+    """Trajectories written by other processes in shared memory, exposed as numpy views.
+
+    The trajectories of each segment are a TrajectoryBatch over the shared memory, and the whole
+    collection has the same interface of a TrajectoryBatch, without copying them, except for
+    `data`: trajectories are spread over several segments, and `to_batch` copies them into a
+    single TrajectoryBatch. Call `close` (or use it as a context manager) to release the memory,
+    after which the views must not be used anymore.
+    """
+
+    def __init__(self, segments_layouts):
+        from multiprocessing import shared_memory
+
+        self._segments = []
+        self._batches = []
+        for name, lengths, num_columns in segments_layouts:
+            segment = shared_memory.SharedMemory(name=name)
+            self._segments.append(segment)
+
+            data = np.ndarray((sum(lengths), num_columns), dtype=float, buffer=segment.buf)
+            self._batches.append(TrajectoryBatch(data, np.cumsum([0] + list(lengths))))
+        self._trajectories = [trajectory for batch in self._batches for trajectory in batch]
+
+    def __len__(self):
+        return len(self._trajectories)
+
+    def __getitem__(self, index):
+        return self._trajectories[index]
+
+    def __iter__(self):
+        return iter(self._trajectories)
+
+    @property
+    def lengths(self):
+        return np.array([trajectory.shape[0] for trajectory in self._trajectories], dtype=np.int64)
+
+    @property
+    def offsets(self):
+        """Offsets of the trajectories as if they were concatenated, as in `to_batch`."""
+        return np.concatenate(([0], np.cumsum(self.lengths)))
+
+    def to_batch(self):
+        """Copy the trajectories into a TrajectoryBatch, which outlives the shared memory."""
+        return TrajectoryBatch.concatenate(self._batches)
+
+    def time_window(self, t_start, t_end):
+        return TrajectoryBatch.concatenate(batch.time_window(t_start, t_end)
+                                           for batch in self._batches)
+
+    def resample(self, times_grid):
+        if not self._batches:
+            return self.to_batch().resample(times_grid)
+        return np.concatenate([batch.resample(times_grid) for batch in self._batches])
+
+    def save(self, file):
+        self.to_batch().save(file)
+
+    def close(self):
+        self._trajectories = []
+        self._batches = []
+        for segment in self._segments:
+            try:
+                segment.close()
+            except BufferError:
+                # Views still referenced elsewhere keep the memory mapped until they're collected.
+                pass
+            segment.unlink()
+        self._segments = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
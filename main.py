@@ -35,8 +35,8 @@ def main():
 
 
 if __name__ == "__main__":
-    controller = main()
-    times_and_populations = controller.simulate()
+    with main() as controller:
+        times_and_populations = controller.simulate()
 
     from pprint import pprint
-    pprint(times_and_populations)
+    pprint(list(times_and_populations))
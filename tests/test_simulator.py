@@ -2,8 +2,27 @@
 
 from . import context
 import unittest
+import boppy.core
 import boppy.simulators.ssa as ssa
+import boppy.simulators.ssa_ensemble as ssa_ensemble
 import boppy.simulators.next_reaction_method as nrm
+import boppy.simulators.optimized_direct_method as odm
+import boppy.simulators.composition_rejection as cr
+import boppy.simulators.sorting_direct_method as sdm
+import boppy.simulators.rejection_ssa as rssa
+import boppy.simulators.tau_leaping as tau_leaping
+import boppy.simulators.chemical_langevin as chemical_langevin
+import boppy.simulators.hybrid as hybrid
+import boppy.simulators.slow_scale_ssa as slow_scale_ssa
+import boppy.simulators.fluid_approximation as fluid_approximation
+import boppy.simulators.moment_equations as moment_equations
+import boppy.simulators.sensitivity as sensitivity
+from scipy.integrate import odeint
+import sympy as sym
+from boppy.utils.trajectory import TrajectoryBuffer, TrajectoryBatch, SharedTrajectories, \
+    shared_memory_available, write_shared_trajectories
+from tempfile import TemporaryDirectory
+import os.path
 
 import numpy as np
 
@@ -19,6 +38,19 @@ class SimulatorsTest(unittest.TestCase):
         self.t_max_1 = 100
         self.nrm_affects_1 = [[0, 1], [1, 2], [0, 2]]
         self.nrm_depends_on_1 = [[0, 1], [1], [2]]
+        self.rate_functions_coll_1 = boppy.core.RateFunctionCollection(
+            ["k_i * x_i * x_s / N", "k_r * x_i", "k_s * x_r"],
+            boppy.core.VariableCollection(["x_s", "x_i", "x_r"]),
+            boppy.core.ParameterCollection({'k_i': 1, 'k_r': 0.05, 'k_s': 0.01, 'N': 10}))
+
+        # The rate of the second reaction depends on x_y, which is not one of its reagents.
+        self.update_matrix_catalyst = np.array([[-1, 1, 0, 0], [0, 0, -1, 1]])
+        self.initial_conditions_catalyst = np.array([100, 0, 100, 0])
+        self.rate_functions_catalyst = boppy.core.RateFunctionCollection(
+            ["k_1 * x_x", "k_2 * x_y * x_z"],
+            boppy.core.VariableCollection(["x_x", "x_y", "x_z", "x_w"]),
+            boppy.core.ParameterCollection({'k_1': 1, 'k_2': 0.01}))
+        self.affects_catalyst = [[0, 1], [2, 3]]
 
         self.update_matrix_2 = np.array([1, 2, 3, 4])
         self.initial_conditions_2 = np.array([1, 2, 3, 4])
@@ -43,6 +75,516 @@ class SimulatorsTest(unittest.TestCase):
         self.assertTrue(np.allclose(times_and_states_trajectories[-3:, :],
                                     exp_trajectory_times_and_states))
 
+    def test_SSA_ensemble(self):
+        trajectories = ssa_ensemble.SSA(self.update_matrix_1, self.initial_conditions_1,
+                                        self.rate_functions_1, self.t_max_1, iterations=50)
+
+        self.assertEqual(len(trajectories), 50)
+        for times_and_states in trajectories:
+            self.assertTrue(np.array_equal(times_and_states[0], [0, 8, 2, 0]))
+            self.assertTrue(np.all(np.diff(times_and_states[:, 0]) > 0))
+            self.assertTrue(np.all(times_and_states[:-1, 0] < self.t_max_1))
+            self.assertGreaterEqual(times_and_states[-1, 0], self.t_max_1)
+            # The total population of the model is conserved by every reaction.
+            self.assertTrue(np.all(times_and_states[:, 1:].sum(axis=1) == 10))
+
+    def test_optimized_direct_method_matches_SSA(self):
+        secondary_parameters = {'affects': self.nrm_affects_1, 'depends_on': self.nrm_depends_on_1}
+
+        odm_trajectory = odm.optimized_direct_method(self.update_matrix_1,
+                                                     self.initial_conditions_1,
+                                                     self.rate_functions_coll_1,
+                                                     self.t_max_1,
+                                                     **secondary_parameters)
+        np.random.seed(42)
+        ssa_trajectory = ssa.SSA(self.update_matrix_1, self.initial_conditions_1,
+                                 self.rate_functions_1, self.t_max_1)
+
+        # Both methods draw the same random numbers, so that only the rates evaluation differs.
+        self.assertEqual(odm_trajectory.shape, ssa_trajectory.shape)
+        self.assertTrue(np.allclose(odm_trajectory, ssa_trajectory))
+
+    def test_optimized_direct_method_catalyst(self):
+        self.assertTrue(np.array_equal(self.rate_functions_catalyst.depends_on[1], [1, 2]))
+
+        odm_trajectory = odm.optimized_direct_method(
+            self.update_matrix_catalyst, self.initial_conditions_catalyst,
+            self.rate_functions_catalyst, 1, affects=self.affects_catalyst,
+            depends_on=self.rate_functions_catalyst.depends_on)
+        np.random.seed(42)
+        ssa_trajectory = ssa.SSA(self.update_matrix_catalyst, self.initial_conditions_catalyst,
+                                 self.rate_functions_catalyst, 1)
+
+        self.assertGreater(odm_trajectory[-1, 4], 0)
+        self.assertEqual(odm_trajectory.shape, ssa_trajectory.shape)
+        self.assertTrue(np.allclose(odm_trajectory, ssa_trajectory))
+
+    def test_sorting_direct_method(self):
+        secondary_parameters = {'affects': self.nrm_affects_1, 'depends_on': self.nrm_depends_on_1}
+
+        with self.assertLogs("boppy.simulators.sorting_direct_method", level="INFO") as logs:
+            times_and_states = sdm.sorting_direct_method(self.update_matrix_1,
+                                                         self.initial_conditions_1,
+                                                         self.rate_functions_coll_1,
+                                                         self.t_max_1,
+                                                         **secondary_parameters)
+
+        self.assertIn("final search order", logs.output[0])
+        self.assertTrue(np.array_equal(times_and_states[0], [0, 8, 2, 0]))
+        self.assertTrue(np.all(np.diff(times_and_states[:, 0]) > 0))
+        self.assertGreaterEqual(times_and_states[-1, 0], self.t_max_1)
+        self.assertTrue(np.all(times_and_states[:, 1:] >= 0))
+        self.assertTrue(np.all(times_and_states[:, 1:].sum(axis=1) == 10))
+
+    def test_sorting_direct_method_catalyst(self):
+        times_and_states = sdm.sorting_direct_method(
+            self.update_matrix_catalyst, self.initial_conditions_catalyst,
+            self.rate_functions_catalyst, 1, affects=self.affects_catalyst,
+            depends_on=self.rate_functions_catalyst.depends_on)
+
+        # The second rate is zero at the start, so it changes only if it's recomputed.
+        self.assertGreater(times_and_states[-1, 4], 0)
+
+    def test_rejection_ssa(self):
+        times_and_states = rssa.rejection_ssa(self.update_matrix_1, self.initial_conditions_1,
+                                              self.rate_functions_coll_1, self.t_max_1,
+                                              depends_on=self.nrm_depends_on_1)
+
+        self.assertTrue(np.array_equal(times_and_states[0], [0, 8, 2, 0]))
+        self.assertTrue(np.all(np.diff(times_and_states[:, 0]) > 0))
+        self.assertGreaterEqual(times_and_states[-1, 0], self.t_max_1)
+        self.assertTrue(np.all(times_and_states[:, 1:] >= 0))
+        self.assertTrue(np.all(times_and_states[:, 1:].sum(axis=1) == 10))
+
+    def test_rejection_ssa_catalyst(self):
+        final_w = [rssa.rejection_ssa(self.update_matrix_catalyst,
+                                      self.initial_conditions_catalyst,
+                                      self.rate_functions_catalyst, 1,
+                                      depends_on=self.rate_functions_catalyst.depends_on)[-2, 4]
+                   for _ in range(20)]
+
+        # The bounds of the second rate stay close to zero unless they follow x_y.
+        self.assertGreater(np.mean(final_w), 20)
+
+    def test_rejection_ssa_decay_mean(self):
+        rate_functions = boppy.core.RateFunctionCollection(["k * x"],
+                                                           boppy.core.VariableCollection(["x"]),
+                                                           boppy.core.ParameterCollection({'k': 1}))
+        with self.assertLogs("boppy.simulators.rejection_ssa", level="INFO") as logs:
+            final_states = [rssa.rejection_ssa(np.array([[-1]]), np.array([1000]), rate_functions,
+                                               0.5, depends_on=[[0]])[-2, 1]
+                            for _ in range(20)]
+
+        self.assertAlmostEqual(np.mean(final_states), 1000 * np.exp(-0.5), delta=15)
+        self.assertIn("exact rate evaluations", logs.output[0])
+
+    def test_rejection_ssa_bounds_over_box_corners(self):
+        # Increasing in x_x and decreasing in x_y: the extremes are on the mixed corners.
+        rate_functions = boppy.core.RateFunctionCollection(
+            ["k * x_x / (1 + x_y / 10)"], boppy.core.VariableCollection(["x_x", "x_y"]),
+            boppy.core.ParameterCollection({'k': 1}))
+        lower_states, upper_states = rssa._fluctuation_intervals(np.array([100., 100.]), 0.1)
+        lower_rates, upper_rates = np.empty(1), np.empty(1)
+        rssa._bound_rates(rate_functions, rate_functions.depends_on,
+                          rssa._box_corners(rate_functions.depends_on), lower_states, upper_states,
+                          [0], lower_rates, upper_rates)
+
+        self.assertAlmostEqual(lower_rates[0], 90 / 12)
+        self.assertAlmostEqual(upper_rates[0], 110 / 10)
+
+    def test_rejection_ssa_non_monotone_rate_exc(self):
+        # The rate peaks at x_x = 15, inside the fluctuation interval.
+        rate_functions = boppy.core.RateFunctionCollection(
+            ["x_x * (30 - x_x) + x_y - 200"], boppy.core.VariableCollection(["x_x", "x_y"]),
+            boppy.core.ParameterCollection({}))
+        with self.assertRaisesRegex(boppy.core.InputError, "out of its bounds"):
+            rssa.rejection_ssa(np.array([[0, 0]]), np.array([15, 1]), rate_functions, 10,
+                               depends_on=rate_functions.depends_on)
+
+    def test_composition_rejection(self):
+        secondary_parameters = {'affects': self.nrm_affects_1, 'depends_on': self.nrm_depends_on_1}
+
+        times_and_states = cr.composition_rejection(self.update_matrix_1,
+                                                    self.initial_conditions_1,
+                                                    self.rate_functions_coll_1,
+                                                    self.t_max_1,
+                                                    **secondary_parameters)
+
+        self.assertTrue(np.array_equal(times_and_states[0], [0, 8, 2, 0]))
+        self.assertTrue(np.all(np.diff(times_and_states[:, 0]) > 0))
+        self.assertGreaterEqual(times_and_states[-1, 0], self.t_max_1)
+        self.assertTrue(np.all(times_and_states[:, 1:] >= 0))
+        self.assertTrue(np.all(times_and_states[:, 1:].sum(axis=1) == 10))
+
+    def test_composition_rejection_catalyst(self):
+        times_and_states = cr.composition_rejection(
+            self.update_matrix_catalyst, self.initial_conditions_catalyst,
+            self.rate_functions_catalyst, 1, affects=self.affects_catalyst,
+            depends_on=self.rate_functions_catalyst.depends_on)
+
+        # The second rate is zero at the start, so it changes only if it's recomputed.
+        self.assertGreater(times_and_states[-1, 4], 0)
+
+    def test_composition_rejection_selection_frequencies(self):
+        rates = np.array([0.3, 5., 0., 2.2, 2.9, 40.])
+        groups = cr.RejectionGroups(rates)
+        self.assertAlmostEqual(groups.total, rates.sum())
+
+        rates[4], rates[5] = 0.1, 0.
+        groups.update(4, 2.9, 0.1)
+        groups.update(5, 40., 0.)
+        self.assertAlmostEqual(groups.total, rates.sum())
+
+        samples = [groups.select(rates, np.random.random_sample() * groups.total)
+                   for _ in range(20000)]
+        self.assertTrue(np.allclose(np.bincount(samples, minlength=6) / 20000,
+                                    rates / rates.sum(), atol=0.02))
+
+    def test_tau_leaping_large_population(self):
+        update_matrix = self.update_matrix_1 * 1.
+        initial_conditions = self.initial_conditions_1 * 10000
+        reagents = np.array([[1., 1., 0.], [0., 1., 0.], [0., 0., 1.]])
+        rate_functions = lambda var: np.array([var[1] * var[0] / 100000,  # noqa: E731
+                                               0.05 * var[1], 0.01 * var[2]])
+
+        times_and_states = tau_leaping.tau_leaping(update_matrix, initial_conditions,
+                                                   rate_functions, self.t_max_1, reagents=reagents)
+
+        self.assertTrue(np.all(np.diff(times_and_states[:, 0]) > 0))
+        self.assertAlmostEqual(times_and_states[-1, 0], self.t_max_1)
+        self.assertTrue(np.all(times_and_states[:, 1:] >= 0))
+        self.assertTrue(np.all(times_and_states[:, 1:].sum(axis=1) == 100000))
+        # The exact SSA would need hundreds of thousands of events.
+        self.assertLess(times_and_states.shape[0], 5000)
+
+    def test_tau_leaping_decay_mean(self):
+        final_states = [tau_leaping.tau_leaping(np.array([[-1.]]), np.array([10000.]),
+                                                lambda var: 0.1 * var, 10,
+                                                reagents=np.array([[1.]]))[-1, 1]
+                        for _ in range(20)]
+        self.assertAlmostEqual(np.mean(final_states), 10000 * np.exp(-1), delta=50)
+
+    def test_chemical_langevin_decay(self):
+        trajectories = chemical_langevin.chemical_langevin(np.array([[-1.]]), np.array([10000.]),
+                                                           lambda var: 0.1 * var, 10,
+                                                           iterations=200, time_step=0.01)
+
+        self.assertEqual(len(trajectories), 200)
+        self.assertEqual(trajectories[0].shape, (1001, 2))
+        self.assertTrue(np.allclose(trajectories[0][:, 0], np.linspace(0, 10, 1001)))
+
+        final_states = np.array([trajectory[-1, 1] for trajectory in trajectories])
+        self.assertAlmostEqual(final_states.mean(), 10000 * np.exp(-1), delta=15)
+        # The variance of the number of survivors is binomial.
+        self.assertAlmostEqual(final_states.var() / (10000 * np.exp(-1) * (1 - np.exp(-1))), 1,
+                               delta=0.3)
+
+    def test_chemical_langevin_boundaries(self):
+        for boundary in chemical_langevin.BOUNDARIES_AVAIL:
+            trajectories = chemical_langevin.chemical_langevin(self.update_matrix_1,
+                                                               self.initial_conditions_1,
+                                                               self.rate_functions_1,
+                                                               self.t_max_1, iterations=20,
+                                                               boundary=boundary)
+            for times_and_states in trajectories:
+                self.assertTrue(np.all(times_and_states[:, 1:] >= 0))
+
+    def test_hybrid_partition_reactions(self):
+        update_matrix = np.array([[-1, 1, 0], [1, -1, 0], [0, 0, 1]])
+        fast = hybrid.partition_reactions(update_matrix, np.array([1000, 50, 2]),
+                                          np.array([1000, 50, 1]), 10, 100)
+        self.assertTrue(np.array_equal(fast, [False, False, False]))
+
+        fast = hybrid.partition_reactions(update_matrix, np.array([1000, 500, 2]),
+                                          np.array([1000, 500, 1]), 10, 100)
+        self.assertTrue(np.array_equal(fast, [True, True, False]))
+
+    def test_hybrid_ssa_ode(self):
+        # Fast isomerization between x_a and x_b, and slow production of x_c catalyzed by x_a.
+        update_matrix = np.array([[-1., 1, 0], [1, -1, 0], [0, 0, 1]])
+        rate_functions = lambda var: np.array([var[0], var[1], 0.001 * var[0]])  # noqa
+        expected_x_c = 0.001 * (500 * 10 + 250 * (1 - np.exp(-20)))
+
+        for kwargs in ({'fast_reactions': [0, 1]}, {}):
+            final_states = np.array([hybrid.hybrid_ssa_ode(update_matrix,
+                                                           np.array([1000., 0, 0]),
+                                                           rate_functions, 10, **kwargs)[-1]
+                                     for _ in range(50)])
+            self.assertTrue(np.allclose(final_states[:, 0], 10))
+            self.assertTrue(np.allclose(final_states[:, 1:3], 500))
+            self.assertTrue(np.array_equal(final_states[:, 3], np.round(final_states[:, 3])))
+            self.assertAlmostEqual(final_states[:, 3].mean(), expected_x_c, delta=1)
+
+    def test_find_fast_reversible_pairs(self):
+        # Fast isomerization between x_a and x_b, slow production of x_c catalyzed by x_b.
+        update_matrix = np.array([[-1., 1, 0], [1, -1, 0], [0, 0, 1]])
+        rate_functions = lambda var: np.array([100 * var[0], 100 * var[1], 0.1 * var[1]])  # noqa
+
+        # The pair is fast even if x_b is initially absent.
+        self.assertEqual(slow_scale_ssa.find_fast_reversible_pairs(
+            update_matrix, np.array([100., 0, 0]), rate_functions), [(0, 1)])
+        self.assertEqual(slow_scale_ssa.find_fast_reversible_pairs(
+            update_matrix, np.array([50., 50, 0]), rate_functions, fast_ratio=2000), [])
+        self.assertEqual(slow_scale_ssa.find_fast_reversible_pairs(
+            self.update_matrix_1, self.initial_conditions_1, self.rate_functions_1), [])
+
+    def test_slow_scale_ssa(self):
+        update_matrix = np.array([[-1., 1, 0], [1, -1, 0], [0, 0, 1]])
+        rate_functions = lambda var: np.array([100 * var[0], 100 * var[1], 0.1 * var[1]])  # noqa
+
+        trajectories = [slow_scale_ssa.slow_scale_ssa(update_matrix, np.array([100., 0, 0]),
+                                                      rate_functions, 10,
+                                                      depends_on=[[0], [1], [1]])
+                        for _ in range(50)]
+        # Only the slow reaction fires, and x_b is 50 on average.
+        for trajectory in trajectories:
+            self.assertTrue(np.all(np.diff(trajectory[:, 3]) == 1))
+            self.assertTrue(np.allclose(trajectory[:, 1] + trajectory[:, 2], 100))
+        self.assertAlmostEqual(np.mean([trajectory[-1, 3] for trajectory in trajectories]),
+                               0.1 * 50 * 10, delta=3)
+
+    def test_slow_scale_ssa_caches_fast_distributions(self):
+        update_matrix = np.array([[-1., 1, 0], [1, -1, 0], [0, 0, 1]])
+        rate_functions = lambda var: np.array([100 * var[0], 100 * var[1], 0.1 * var[1]])  # noqa
+
+        # The slow reaction doesn't change the species of the pair, so its distribution is
+        # computed only once; a slow reaction changing them requires it every time.
+        with self.assertLogs("boppy.simulators.slow_scale_ssa", level="INFO") as logs:
+            trajectory = slow_scale_ssa.slow_scale_ssa(update_matrix, np.array([100., 0, 0]),
+                                                       rate_functions, 10,
+                                                       depends_on=[[0], [1], [1]])
+        self.assertGreater(trajectory.shape[0], 10)
+        self.assertIn(", 1 fast distributions computed", logs.output[0])
+
+        update_matrix[2] = [0, -1, 1]
+        with self.assertLogs("boppy.simulators.slow_scale_ssa", level="INFO") as logs:
+            trajectory = slow_scale_ssa.slow_scale_ssa(update_matrix, np.array([100., 0, 0]),
+                                                       rate_functions, 1,
+                                                       depends_on=[[0], [1], [1]])
+        self.assertIn(", {} fast distributions computed".format(trajectory.shape[0] - 1),
+                      logs.output[0])
+
+    def test_conservation_laws(self):
+        laws = boppy.core.ConservationLaws(self.update_matrix_1)
+        self.assertEqual(len(laws), 1)
+        self.assertTrue(np.array_equal(laws.matrix, [[1, 1, 1]]))
+        self.assertTrue(np.array_equal(laws.dependent, [0]))
+        self.assertTrue(np.array_equal(laws.independent, [1, 2]))
+
+        totals = laws.totals(self.initial_conditions_1)
+        self.assertTrue(np.allclose(laws.reconstruct(np.array([[2, 0], [5, 3]]), totals),
+                                    [[8, 2, 0], [2, 5, 3]]))
+
+        x_s, x_i, x_r = sym.symbols("x_s x_i x_r")
+        substitutions = laws.substitutions([x_s, x_i, x_r], totals)
+        self.assertEqual(list(substitutions), [x_s])
+        self.assertEqual(sym.simplify(substitutions[x_s] - (10 - x_i - x_r)), 0)
+
+        # Binding and unbinding: the free and bound forms of each molecule are conserved.
+        laws = boppy.core.ConservationLaws(np.array([[-1, -1, 1], [1, 1, -1]]))
+        self.assertEqual(len(laws), 2)
+        self.assertTrue(np.array_equal(laws.independent, [2]))
+        self.assertTrue(np.allclose(laws.reconstruct(np.array([3]), laws.totals([10, 5, 0])),
+                                    [7, 2, 3]))
+
+        self.assertEqual(len(boppy.core.ConservationLaws(np.eye(2))), 0)
+
+    def test_fluid_approximation(self):
+        variables = boppy.core.VariableCollection(["x_s", "x_i", "x_r"])
+        rate_functions_var_ss = boppy.core.RateFunctionCollection(
+            ["k_i * x_i * x_s / N", "k_r * x_i", "k_s * x_r"], variables,
+            boppy.core.ParameterCollection({'k_i': 1, 'k_r': 0.05, 'k_s': 0.01}))
+        secondary_parameters = {'rate_functions_var_ss': rate_functions_var_ss,
+                                'variables': variables,
+                                'system_size': boppy.core.Parameter("N", 10)}
+
+        expected_states = odeint(lambda x, t: [-x[0] * x[1] + 0.01 * x[2],
+                                               x[0] * x[1] - 0.05 * x[1],
+                                               0.05 * x[1] - 0.01 * x[2]],
+                                 [0.8, 0.2, 0], np.linspace(0, self.t_max_1, 1000))
+
+        # The solvers of solve_ivp have a relative tolerance of 1e-3 by default.
+        for ode_solver, atol in ((None, 1e-5), ("LSODA", 2e-3), ("BDF", 2e-3)):
+            times_and_states = fluid_approximation.fluid_approximation(
+                self.update_matrix_1, self.initial_conditions_1, None, self.t_max_1,
+                ode_solver=ode_solver, **secondary_parameters)
+
+            self.assertEqual(times_and_states.shape, (1000, 4))
+            self.assertTrue(np.allclose(times_and_states[:, 1:], expected_states, atol=atol))
+            # The total density is conserved exactly.
+            self.assertTrue(np.allclose(times_and_states[:, 1:].sum(axis=1), 1, atol=1e-12))
+
+    def test_fluid_approximation_sweep(self):
+        variables = boppy.core.VariableCollection(["x_s", "x_i", "x_r"])
+        parameters = boppy.core.ParameterCollection({'k_i': 1, 'k_r': 0.05, 'k_s': 0.01})
+        rate_functions_var_ss = boppy.core.RateFunctionCollection(
+            ["k_i * x_i * x_s / N", "k_r * x_i", "k_s * x_r"], variables, parameters)
+        parameters_sets = [{'k_i': k_i, 'k_r': k_r} for k_i in (0.5, 1, 2) for k_r in (0.05, 0.1)]
+
+        for processes in (1, 2):
+            times_and_states = fluid_approximation.fluid_approximation_sweep(
+                self.update_matrix_1, self.initial_conditions_1, None, self.t_max_1,
+                rate_functions_var_ss=rate_functions_var_ss, variables=variables,
+                system_size=boppy.core.Parameter("N", 10), parameters=parameters,
+                parameters_sets=parameters_sets, ode_solver="Radau", processes=processes)
+
+            self.assertEqual(times_and_states.shape, (6, 1000, 4))
+            for parameters_set, set_times_and_states in zip(parameters_sets, times_and_states):
+                k_i, k_r = parameters_set['k_i'], parameters_set['k_r']
+                expected_states = odeint(lambda x, t: [-k_i * x[0] * x[1] + 0.01 * x[2],
+                                                       k_i * x[0] * x[1] - k_r * x[1],
+                                                       k_r * x[1] - 0.01 * x[2]],
+                                         [0.8, 0.2, 0], np.linspace(0, self.t_max_1, 1000))
+                self.assertTrue(np.allclose(set_times_and_states[:, 0],
+                                            np.linspace(0, self.t_max_1, 1000)))
+                self.assertTrue(np.allclose(set_times_and_states[:, 1:], expected_states,
+                                            atol=2e-3))
+
+    def test_fluid_approximation_sweep_keyword_parameter(self):
+        variables = boppy.core.VariableCollection(["x"])
+        parameters = boppy.core.ParameterCollection({'lambda': 1})
+        rate_functions_var_ss = boppy.core.RateFunctionCollection(["lambda * x"], variables,
+                                                                  parameters)
+
+        times_and_states = fluid_approximation.fluid_approximation_sweep(
+            np.array([[-1]]), np.array([10]), None, 1,
+            rate_functions_var_ss=rate_functions_var_ss, variables=variables,
+            system_size=boppy.core.Parameter("N", 10), parameters=parameters,
+            parameters_sets=[{'lambda': 1}, {'lambda': 2}], processes=1)
+
+        self.assertTrue(np.allclose(times_and_states[:, -1, 1], np.exp([-1, -2]), atol=1e-3))
+
+    def test_stacked_drift_jacobian(self):
+        x, y, k = sym.symbols("x y k")
+        compiled_drift = fluid_approximation.CompiledDrift([-k * x * y, k * x * y - y], [x, y],
+                                                           [k])
+        stacked_drift = fluid_approximation.StackedDrift(compiled_drift, [[1, 2, 3]])
+
+        states = np.array([1., 2, 3, 4, 5, 6])
+        self.assertTrue(np.allclose(stacked_drift.drift(states),
+                                    [-2, 0, -24, 20, -90, 84]))
+        jacobian = stacked_drift.jacobian(states).toarray()
+        self.assertTrue(np.allclose(jacobian[2:4, 2:4], [[-8, -6], [8, 5]]))
+        self.assertEqual(np.count_nonzero(jacobian[:2, 2:]), 0)
+
+    def test_fluid_sensitivities_decay(self):
+        variables = boppy.core.VariableCollection(["x_a", "x_b"])
+        parameters = boppy.core.ParameterCollection({'k': 2})
+        rate_functions_var_ss = boppy.core.RateFunctionCollection(["k * x_a"], variables,
+                                                                  parameters)
+
+        times_and_states, sensitivities = sensitivity.fluid_sensitivities(
+            np.array([[-1, 1]]), np.array([10, 0]), None, 2,
+            rate_functions_var_ss=rate_functions_var_ss, variables=variables,
+            system_size=boppy.core.Parameter("N", 10), parameters=parameters)
+
+        t = times_and_states[:, 0]
+        self.assertEqual(sensitivities.shape, (1000, 2, 1))
+        self.assertTrue(np.allclose(times_and_states[:, 1], np.exp(-2 * t), atol=1e-6))
+        # x_a = exp(-k t), so d x_a / dk = -t exp(-k t), and x_b = 1 - x_a.
+        self.assertTrue(np.allclose(sensitivities[:, 0, 0], -t * np.exp(-2 * t), atol=1e-6))
+        self.assertTrue(np.allclose(sensitivities[:, 1, 0], t * np.exp(-2 * t), atol=1e-6))
+
+        gradients = sensitivity.output_gradients(["x_a * x_a", "x_a + x_b"], variables,
+                                                 times_and_states[:, 1:], sensitivities)
+        self.assertEqual(gradients.shape, (1000, 2, 1))
+        self.assertTrue(np.allclose(gradients[:, 0, 0], -2 * t * np.exp(-4 * t), atol=1e-6))
+        self.assertTrue(np.allclose(gradients[:, 1, 0], 0))
+
+    def test_fluid_sensitivities_finite_differences(self):
+        variables = boppy.core.VariableCollection(["x_s", "x_i", "x_r"])
+        parameters_values = {'k_i': 1, 'k_r': 0.05, 'k_s': 0.01}
+        secondary_parameters = {'variables': variables,
+                                'system_size': boppy.core.Parameter("N", 10)}
+
+        def rate_functions(values):
+            return boppy.core.RateFunctionCollection(
+                ["k_i * x_i * x_s / N", "k_r * x_i", "k_s * x_r"], variables,
+                boppy.core.ParameterCollection(values))
+
+        _, sensitivities = sensitivity.fluid_sensitivities(
+            self.update_matrix_1, self.initial_conditions_1, None, self.t_max_1,
+            rate_functions_var_ss=rate_functions(parameters_values),
+            parameters=boppy.core.ParameterCollection(parameters_values),
+            sensitivity_parameters=["k_r", "k_i"], **secondary_parameters)
+        self.assertEqual(sensitivities.shape, (1000, 3, 2))
+
+        for index, name in enumerate(["k_r", "k_i"]):
+            states = []
+            # Small steps would be dominated by the tolerance of the ODE solver.
+            for step in (1e-4, -1e-4):
+                values = dict(parameters_values, **{name: parameters_values[name] + step})
+                states.append(fluid_approximation.fluid_approximation(
+                    self.update_matrix_1, self.initial_conditions_1, None, self.t_max_1,
+                    rate_functions_var_ss=rate_functions(values), **secondary_parameters))
+            finite_differences = (states[0][:, 1:] - states[1][:, 1:]) / 2e-4
+            self.assertTrue(np.allclose(sensitivities[:, :, index], finite_differences,
+                                        atol=1e-3))
+
+    def test_fluid_approximation_scaling(self):
+        variables = boppy.core.VariableCollection(["x_s", "x_i"])
+        rate_functions_var_ss = boppy.core.RateFunctionCollection(
+            ["k * x_i * x_s / N", "k * x_s / (1 + x_s / N)", "x_i / exp(x_s / N)", "k",
+             "x_i / (N + sqrt(N))"],
+            variables, boppy.core.ParameterCollection({'k': 2}))
+        system_size = boppy.core.Parameter("N", 100)
+        d_s, d_i = sym.symbols("d_x_s d_x_i")
+
+        cache_hits = fluid_approximation._scale_sym_functions.cache_info().hits
+        for _ in range(2):
+            f_funcs = fluid_approximation.scaling(rate_functions_var_ss,
+                                                  fluid_approximation.density_symbols(variables),
+                                                  system_size)
+
+            self.assertEqual(sym.simplify(f_funcs[0] - 2 * d_i * d_s), 0)
+            self.assertEqual(sym.simplify(f_funcs[1] - 2 * d_s / (1 + d_s)), 0)
+            self.assertEqual(sym.simplify(f_funcs[2] - d_i * sym.exp(-d_s)), 0)
+            self.assertEqual(f_funcs[3], 0)
+            # Not rational in N: computed with sym.limit.
+            self.assertEqual(f_funcs[4], 0)
+
+        self.assertEqual(fluid_approximation._scale_sym_functions.cache_info().hits,
+                         cache_hits + 1)
+
+    def test_moment_equations_isomerization(self):
+        # A <=> B with linear rates: at equilibrium A is binomially distributed, and both methods
+        # are exact for the first two moments.
+        variables = boppy.core.VariableCollection(["x_a", "x_b"])
+        rate_functions = boppy.core.RateFunctionCollection(
+            ["k_1 * x_a", "k_2 * x_b"], variables,
+            boppy.core.ParameterCollection({'k_1': 1, 'k_2': 0.5}))
+        update_matrix = np.array([[-1, 1], [1, -1]])
+        p_a = 0.5 / 1.5
+
+        for method in (moment_equations.linear_noise_approximation,
+                       moment_equations.moment_closure):
+            times_and_moments = method(update_matrix, np.array([100, 0]), rate_functions, 20,
+                                       variables=variables)
+
+            self.assertEqual(times_and_moments.shape, (1000, 1 + 2 + 4))
+            self.assertTrue(np.allclose(times_and_moments[-1, 1:3], [100 * p_a, 100 * (1 - p_a)],
+                                        atol=1e-3))
+            variance = 100 * p_a * (1 - p_a)
+            self.assertTrue(np.allclose(times_and_moments[-1, 3:],
+                                        [variance, -variance, -variance, variance], atol=1e-3))
+
+    def test_moment_closure_second_order_correction(self):
+        # 2 A => B: the closure increases the expected rate by the term k * var(A) / 2, compared
+        # to the linear noise approximation.
+        variables = boppy.core.VariableCollection(["x_a", "x_b"])
+        rate_functions = boppy.core.RateFunctionCollection(
+            ["k * x_a * (x_a - 1) / 2"], variables, boppy.core.ParameterCollection({'k': 0.01}))
+        update_matrix = np.array([[-2, 1]])
+
+        lna = moment_equations.linear_noise_approximation(update_matrix, np.array([100, 0]),
+                                                          rate_functions, 1, variables=variables)
+        closure = moment_equations.moment_closure(update_matrix, np.array([100, 0]),
+                                                  rate_functions, 1, variables=variables)
+
+        self.assertLess(closure[-1, 1], lna[-1, 1])
+        self.assertTrue(np.allclose(lna[:, 1] + 2 * lna[:, 2], 100))
+        self.assertTrue(np.allclose(closure[:, 1] + 2 * closure[:, 2], 100))
+
     def test_next_reaction_method(self):
 
         secondary_parameters = {'affects': self.nrm_affects_1, 'depends_on': self.nrm_depends_on_1}
@@ -65,6 +607,157 @@ class SimulatorsTest(unittest.TestCase):
         self.assertTrue(np.allclose(times_and_states_trajectories[-3:, :],
                                     exp_trajectory_times_and_states))
 
+    def test_partial_sum_tree_update(self):
+        rates = np.array([0.5, 3., 1., 0., 2.5])
+        rates_tree = ssa.PartialSumTree(rates)
+
+        new_rates = np.array([0.5, 1., 1., 4., 2.5])
+        rates_tree.update_changed(new_rates)
+
+        self.assertTrue(np.allclose(rates_tree.tree,
+                                    ssa._initialize_vector_binary_search(new_rates)))
+        self.assertAlmostEqual(rates_tree.total, 9.)
+        self.assertEqual(rates_tree.search(rates_tree.total),
+                         ssa._binary_search_processing(
+                             ssa._initialize_vector_binary_search(new_rates), 9.))
+
+    def test_indexed_priority_queue_update(self):
+        putative_times = np.random.random_sample(20)
+        ipq = nrm.IndexedPriorityQueue(putative_times)
+
+        for index, time in ((3, 0.), (3, 2.), (7, np.inf), (12, 1e-3), (0, 0.5)):
+            putative_times[index] = time
+            ipq.update(index, time)
+
+            self.assertEqual(ipq.min_index, np.argmin(putative_times))
+            for node in range(1, len(ipq)):
+                self.assertLessEqual(ipq.times[(node - 1) // 2], ipq.times[node])
+            for index_, position in enumerate(ipq.positions):
+                self.assertEqual(ipq.indices[position], index_)
+                self.assertEqual(ipq.times[position], putative_times[index_])
+
+    def test_trajectory_buffer_growth(self):
+        trajectory = TrajectoryBuffer(3, initial_capacity=2)
+        states = np.array([8, 2, 0])
+        for time in range(10):
+            trajectory.append(time, states)
+            states += 1
+
+        times_and_states = trajectory.to_array()
+        self.assertEqual(times_and_states.shape, (10, 4))
+        self.assertTrue(np.array_equal(times_and_states[:, 0], np.arange(10)))
+        self.assertTrue(np.array_equal(times_and_states[-1], [9, 17, 11, 9]))
+
+    def test_trajectory_batch(self):
+        trajectories = [ssa.SSA(self.update_matrix_1, self.initial_conditions_1,
+                                self.rate_functions_1, self.t_max_1) for _ in range(4)]
+        batch = TrajectoryBatch.from_list(trajectories)
+
+        self.assertEqual(len(batch), 4)
+        self.assertTrue(np.array_equal(batch.lengths, [len(trajectory)
+                                                       for trajectory in trajectories]))
+        for trajectory, batch_trajectory in zip(trajectories, batch):
+            self.assertTrue(np.array_equal(trajectory, batch_trajectory))
+        self.assertTrue(np.array_equal(batch[-1], trajectories[-1]))
+        self.assertTrue(np.shares_memory(batch[2], batch.data))
+        with self.assertRaises(IndexError):
+            batch[4]
+
+        window = batch.time_window(10, 50)
+        self.assertEqual(len(window), 4)
+        for trajectory, window_trajectory in zip(trajectories, window):
+            inside = (trajectory[:, 0] >= 10) & (trajectory[:, 0] <= 50)
+            self.assertTrue(np.array_equal(trajectory[inside], window_trajectory))
+
+        with TemporaryDirectory() as tmpdirname:
+            filename = os.path.join(tmpdirname, "batch.npz")
+            batch.save(filename)
+            loaded = TrajectoryBatch.load(filename)
+        self.assertTrue(np.array_equal(loaded.data, batch.data))
+        self.assertTrue(np.array_equal(loaded.offsets, batch.offsets))
+
+    def test_trajectory_batch_resample(self):
+        trajectories = [ssa.SSA(self.update_matrix_1, self.initial_conditions_1,
+                                self.rate_functions_1, self.t_max_1) for _ in range(5)]
+        batch = TrajectoryBatch.from_list(trajectories)
+        grid = np.linspace(0, 150, 301)
+
+        resampled = batch.resample(grid)
+        self.assertEqual(resampled.shape, (5, 301, 3))
+        for trajectory, trajectory_resampled in zip(trajectories, resampled):
+            last_events = np.searchsorted(trajectory[:, 0], grid, side='right') - 1
+            self.assertTrue(np.array_equal(trajectory_resampled, trajectory[last_events, 1:]))
+
+        # Exactly on an event time the state after the event is taken.
+        event_time = trajectories[1][3, 0]
+        self.assertTrue(np.array_equal(batch.resample([event_time])[1, 0], trajectories[1][3, 1:]))
+
+    def test_trajectory_batch_resample_before_start(self):
+        batch = TrajectoryBatch.from_list([np.array([[1., 5], [3, 6]]),
+                                           np.array([[0., 1], [2, 2], [4, 3]])])
+        resampled = batch.resample([0.5, 1, 2.5, 10])
+
+        self.assertTrue(np.isnan(resampled[0, 0, 0]))
+        self.assertTrue(np.array_equal(resampled[0, 1:, 0], [5, 5, 6]))
+        self.assertTrue(np.array_equal(resampled[1, :, 0], [1, 1, 2, 3]))
+
+    def test_trajectory_batch_resample_large_offsets(self):
+        # Many trajectories over a long time span, with an event just after the grid time.
+        trajectory = np.array([[0., 1], [10.000001, 2], [1e6, 3]])
+        batch = TrajectoryBatch.from_list([trajectory] * 20000)
+
+        resampled = batch.resample([10., 10.000001, 2e6])
+        self.assertTrue(np.all(resampled[:, 0, 0] == 1))
+        self.assertTrue(np.all(resampled[:, 1, 0] == 2))
+        self.assertTrue(np.all(resampled[:, 2, 0] == 3))
+
+    def test_trajectory_batch_from_dense(self):
+        dense = np.arange(24, dtype=float).reshape(2, 3, 4)
+        batch = TrajectoryBatch.from_dense(dense)
+
+        self.assertTrue(np.array_equal(batch.offsets, [0, 3, 6]))
+        self.assertTrue(np.array_equal(batch[1], dense[1]))
+        self.assertTrue(np.shares_memory(batch.data, dense))
+        self.assertTrue(np.array_equal(batch.trajectory_indices, [0, 0, 0, 1, 1, 1]))
+
+    def test_trajectory_batch_from_dense_end_time(self):
+        # Rows after the first time >= end_time are left unwritten, as by the GPU simulator.
+        dense = np.full((3, 4, 2), np.nan, dtype=np.float32)
+        dense[0] = [[0, 1], [0.5, 2], [1.1, 3], [1.2, 4]]
+        dense[1, :2] = [[0, 1], [1.1, 2]]
+        dense[2] = [[0, 1], [0.2, 2], [0.3, 3], [0.4, 4]]
+        batch = TrajectoryBatch.from_dense(dense, end_time=1.1)
+
+        self.assertTrue(np.array_equal(batch.lengths, [3, 2, 4]))
+        self.assertFalse(np.any(np.isnan(batch.data)))
+        self.assertTrue(np.array_equal(batch[1], dense[1, :2]))
+        self.assertTrue(np.array_equal(batch.resample([2.])[:, 0, 0], [3, 2, 4]))
+
+    @unittest.skipUnless(shared_memory_available(), "shared memory requires Python 3.8")
+    def test_shared_trajectories(self):
+        trajectories = [ssa.SSA(self.update_matrix_1, self.initial_conditions_1,
+                                self.rate_functions_1, self.t_max_1) for _ in range(3)]
+        layouts = [write_shared_trajectories(trajectories[:2]),
+                   write_shared_trajectories(trajectories[2:])]
+        self.assertEqual(layouts[0][1], [trajectories[0].shape[0], trajectories[1].shape[0]])
+
+        with SharedTrajectories(layouts) as shared_trajectories:
+            self.assertEqual(len(shared_trajectories), 3)
+            for trajectory, shared_trajectory in zip(trajectories, shared_trajectories):
+                self.assertTrue(np.array_equal(trajectory, shared_trajectory))
+            # Views over the same memory, not copies.
+            self.assertFalse(shared_trajectories[0].flags.owndata)
+
+            batch = TrajectoryBatch.from_list(trajectories)
+            self.assertTrue(np.array_equal(shared_trajectories.offsets, batch.offsets))
+            self.assertTrue(np.array_equal(shared_trajectories.lengths, batch.lengths))
+            self.assertTrue(np.array_equal(shared_trajectories.resample([0, 30, 60]),
+                                           batch.resample([0, 30, 60])))
+            self.assertTrue(np.array_equal(shared_trajectories.time_window(10, 50).data,
+                                           batch.time_window(10, 50).data))
+            copied = shared_trajectories.to_batch()
+        self.assertTrue(np.array_equal(copied.data, batch.data))
+
     def tearDown(self):
         # Reset the numpy seed to a random value.
         np.random.seed()
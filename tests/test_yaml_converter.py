@@ -4,13 +4,16 @@ import boppy.core
 import boppy.simulators
 import boppy.utils.input_loading as loading_utils
 from boppy.utils.misc import BoppyInputError
+from boppy.utils.trajectory import TrajectoryBatch, shared_memory_available
 
 import multiprocessing as mp
 import numpy as np
 import os.path
 import sympy as sym
 from tempfile import TemporaryDirectory
+import time
 import unittest
+from unittest import mock
 
 
 class YAMLTest(unittest.TestCase):
@@ -140,6 +143,23 @@ class BoppyCoreComponentsTest(unittest.TestCase):
         for reac, upd_vec in zip(reaction_collection, self.expected_update_vector):
             self.assertTrue(np.array_equiv(reac.update_vector, upd_vec))
 
+    def test_dependency_graph(self):
+        reaction_collection = boppy.core.ReactionCollection(self.input_data["Reactions"],
+                                                            self.input_data["Species"])
+        graph = boppy.core.DependencyGraph(reaction_collection.affects,
+                                           reaction_collection.depends_on)
+
+        self.assertEqual(len(graph), 3)
+        for reaction_index in range(3):
+            self.assertTrue(np.array_equal(graph[reaction_index], [0, 1, 2]))
+
+        graph = boppy.core.DependencyGraph([[0, 1], [1, 2], [0, 2], []],
+                                           [[0, 1], [1], [2], [0]])
+        self.assertTrue(np.array_equal(graph.offsets, [0, 3, 6, 9, 9]))
+        self.assertTrue(np.array_equal(graph[0], [0, 1, 3]))
+        self.assertTrue(np.array_equal(graph[2], [0, 2, 3]))
+        self.assertEqual(graph[3].shape[0], 0)
+
     def test_all_rate_functions(self):
         for i, _ in enumerate(self.input_data["Rate functions"]):
             rate_func = boppy.core.RateFunction(self.input_data["Rate functions"][i],
@@ -156,6 +176,41 @@ class BoppyCoreComponentsTest(unittest.TestCase):
         self.assertTrue(np.allclose(self.rate_func_coll(self.input_data["Initial conditions"]),
                                     [-2., 16., -100.]))
 
+    def test_compiled_rate_functions_collection_compute_in_points(self):
+        compiled_coll = boppy.core.RateFunctionCollection(self.input_data["Rate functions"],
+                                                          self.input_data["Species"],
+                                                          self.input_data["Parameters"],
+                                                          compiled=True)
+        self.assertTrue(compiled_coll.compiled)
+        self.assertTrue(np.allclose(compiled_coll(self.input_data["Initial conditions"]),
+                                    [-2., 16., -100.]))
+
+        out = np.empty(3)
+        self.assertIs(compiled_coll(np.array([10, 30, 5]), out=out), out)
+        self.assertTrue(np.allclose(out, self.rate_func_coll(np.array([10, 30, 5]))))
+
+    def test_rate_functions_collection_max_min_on_2d_states(self):
+        rate_functions = ["k_i * x_i * x_s / max(N, x_s)", "min(x_i, 3, N) + x_r"]
+        states = np.array([[50., 150., 100.], [1., 2., 5.], [0., 1., 2.]])
+        expected = np.array([[0.5, 2., 5.], [1., 3., 5.]])
+
+        for compiled in (False, True):
+            coll = boppy.core.RateFunctionCollection(rate_functions,
+                                                     self.input_data["Species"],
+                                                     self.input_data["Parameters"],
+                                                     compiled=compiled)
+            self.assertTrue(np.allclose(coll(states), expected))
+            self.assertTrue(np.allclose(coll(states[:, 1]), expected[:, 1]))
+
+    def test_compiled_rate_functions_collection_keyword_species(self):
+        variables = boppy.core.VariableCollection(["lambda", "in"])
+        rate_functions = ["k_i * lambda * in", "max(lambda, 3)"]
+        for compiled in (False, True):
+            coll = boppy.core.RateFunctionCollection(rate_functions, variables,
+                                                     self.input_data["Parameters"],
+                                                     compiled=compiled)
+            self.assertTrue(np.allclose(coll(np.array([2., 5.])), [10., 3.]))
+
     def test_rate_functions_collection_compute_dim_mismatch_exc(self):
         with self.assertRaisesRegex(BoppyInputError, "Array shapes mismatch: input vector \d, rate functions \d."):
             self.rate_func_coll(np.array([1, 2]))
@@ -270,11 +325,267 @@ class BoppyApplicationTest(unittest.TestCase):
             self.assertEqual(arr.shape[1], 1 + len(self.raw_alg_input['Species']))
 
         self.assertTrue(np.allclose(times_and_populations[0][-2:],
-                                    np.array([99.438658085172847, 13, 10, 77,
-                                              100.21927360825548, 14, 10, 76]).reshape(2, 4)))
+                                    np.array([99.89834638240643, 6, 13, 81,
+                                              100.31781549974565, 7, 13, 80]).reshape(2, 4)))
         self.assertTrue(np.allclose(times_and_populations[3][-2:],
-                                    np.array([99.14632023, 3, 13, 84,
-                                              100.3107783, 3, 12, 85]).reshape(2, 4)))
+                                    np.array([99.7856701684385, 11, 15, 74,
+                                              100.32584966322598, 10, 16, 74]).reshape(2, 4)))
+
+    def test_application_controller_simulation_independent_workers(self):
+        with boppy.application.MainControllerCPU(self.raw_alg_input,
+                                                 self.raw_simul_input) as controller:
+            first = controller.simulate()
+            np.random.seed(42)
+            second = controller.simulate()
+
+        # Workers forked from the same process must not repeat the same trajectories.
+        final_states = {tuple(traj[-1]) for traj in first}
+        self.assertEqual(len(final_states), len(first))
+
+        # Seeding the parent process is enough to reproduce the simulation.
+        for traj_first, traj_second in zip(first, second):
+            self.assertTrue(np.array_equal(traj_first, traj_second))
+
+    def test_application_controller_persistent_pool(self):
+        with boppy.application.MainControllerCPU(self.raw_alg_input,
+                                                 self.raw_simul_input) as controller:
+            first_run = controller.simulate()
+            pool = controller._pool
+
+            # Workers keep their random state, so the second run produces new trajectories.
+            second_run = controller.simulate()
+            self.assertIs(controller._pool, pool)
+            self.assertEqual(len(second_run), self.raw_simul_input['Algorithm iterations'])
+            self.assertFalse(np.array_equal(first_run[0], second_run[0]))
+
+            controller.update_parameters({'k_r': 0})
+            self.assertIs(controller._pool, pool)
+            for arr in controller.simulate():
+                # Without recoveries, x_r stays at 0 and the infected can only increase.
+                self.assertTrue(np.all(arr[:, 3] == 0))
+                self.assertTrue(np.all(np.diff(arr[:, 2]) >= 0))
+            # The original dictionary isn't changed.
+            self.assertEqual(self.raw_alg_input['Parameters']['k_r'], 0.05)
+
+        self.assertIsNone(controller._pool)
+
+    def test_application_controller_simulate_iter(self):
+        self.raw_simul_input['Algorithm iterations'] = 7
+        with boppy.application.MainControllerCPU(self.raw_alg_input,
+                                                 self.raw_simul_input) as controller:
+            self.assertEqual([task[2] for task in controller._tasks(3)], [3, 3, 1])
+
+            trajectories = controller.simulate_iter(batch_size=3)
+            first_trajectory = next(trajectories)
+            self.assertTrue(np.allclose(first_trajectory[0], [0, 80, 20, 0]))
+
+            remaining = list(trajectories)
+            self.assertEqual(len(remaining), 6)
+            for arr in remaining:
+                self.assertEqual(arr.shape[1], 1 + len(self.raw_alg_input['Species']))
+                self.assertGreaterEqual(arr[-1, 0],
+                                        self.raw_simul_input['Maximum simulation time'])
+
+    def test_application_controller_simulate_iter_bounded_outstanding(self):
+        self.raw_simul_input['Algorithm iterations'] = 12
+        with boppy.application.MainControllerCPU(self.raw_alg_input,
+                                                 self.raw_simul_input) as controller:
+            pool = controller._get_pool()
+            with mock.patch.object(pool, 'apply_async', wraps=pool.apply_async) as apply_async:
+                # Each batch holds a single trajectory, so consumed trajectories are batches.
+                for consumed, _ in enumerate(controller.simulate_iter(batch_size=1,
+                                                                      max_outstanding=3)):
+                    self.assertLessEqual(apply_async.call_count, consumed + 1 + 3)
+                    time.sleep(0.01)
+
+            self.assertEqual(consumed + 1, 12)
+            self.assertEqual(apply_async.call_count, 12)
+
+    @unittest.skipUnless(shared_memory_available(), "shared memory requires Python 3.8")
+    def test_application_controller_simulation_shared_memory(self):
+        self.raw_simul_input['Use shared memory'] = True
+        with boppy.application.MainControllerCPU(self.raw_alg_input,
+                                                 self.raw_simul_input) as controller:
+            with controller.simulate() as times_and_populations:
+                self.assertEqual(self.raw_simul_input['Algorithm iterations'],
+                                 len(times_and_populations))
+
+                # Each worker computes two consecutive trajectories.
+                self.assertTrue(np.allclose(times_and_populations[0][-2:],
+                                            np.array([99.89834638240643, 6, 13, 81,
+                                                      100.31781549974565, 7, 13,
+                                                      80]).reshape(2, 4)))
+                self.assertTrue(np.allclose(times_and_populations[3][-2:],
+                                            np.array([99.9751405276386, 6, 15, 79,
+                                                      100.02680040940021, 6, 14,
+                                                      80]).reshape(2, 4)))
+            self.assertEqual(len(times_and_populations), 0)
+
+    def test_application_wrong_shared_memory_option(self):
+        with self.assertRaisesRegex(BoppyInputError, "The 'Use shared memory' option must be "
+                                                     "true/false or no/yes; found 'maybe'."):
+            self.raw_simul_input['Use shared memory'] = "maybe"
+            boppy.application.MainControllerCPU(self.raw_alg_input, self.raw_simul_input)
+
+    def test_application_shared_memory_unavailable(self):
+        self.raw_simul_input['Use shared memory'] = True
+        with mock.patch("boppy.application.shared_memory_available", return_value=False):
+            with self.assertRaisesRegex(BoppyInputError, "The 'Use shared memory' option requires "
+                                                         "Python 3.8 or later."):
+                boppy.application.MainControllerCPU(self.raw_alg_input, self.raw_simul_input)
+
+    def test_application_update_unknown_parameters(self):
+        controller = boppy.application.MainControllerCPU(self.raw_alg_input, self.raw_simul_input)
+        with self.assertRaisesRegex(BoppyInputError, "The parameters k_x do not match any "
+                                                     "parameter provided."):
+            controller.update_parameters({'k_x': 1})
+
+    def test_application_controller_spawn_start_method(self):
+        self.raw_simul_input['Process start method'] = "spawn"
+        with boppy.application.MainControllerCPU(self.raw_alg_input,
+                                                 self.raw_simul_input) as controller:
+            times_and_populations = controller.simulate()
+
+        self.assertEqual(len(times_and_populations), self.raw_simul_input['Algorithm iterations'])
+        for arr in times_and_populations:
+            self.assertTrue(np.allclose(arr[0], [0, 80, 20, 0]))
+            self.assertTrue(np.all(arr[:, 1:].sum(axis=1) == 100))
+
+    def test_application_wrong_start_method(self):
+        with self.assertRaisesRegex(BoppyInputError, "The 'Process start method' parameter must "
+                                                     "be one of .*\\."):
+            self.raw_simul_input['Process start method'] = "thread"
+            boppy.application.MainControllerCPU(self.raw_alg_input, self.raw_simul_input)
+
+    def test_application_controller_simulation_trajectory_batch(self):
+        controller = boppy.application.MainControllerCPU(self.raw_alg_input, self.raw_simul_input)
+        times_and_populations = controller.simulate()
+
+        self.assertIsInstance(times_and_populations, TrajectoryBatch)
+        self.assertEqual(times_and_populations.data.shape,
+                         (times_and_populations.lengths.sum(), 4))
+        # Trajectories are views over the same array.
+        self.assertTrue(np.shares_memory(times_and_populations[1], times_and_populations.data))
+        self.assertTrue(np.allclose(times_and_populations[0][-1],
+                                    [100.31781549974565, 7, 13, 80]))
+
+    def test_application_controller_simulation_ensemble(self):
+        self.raw_simul_input["Simulation"] = "SSA ensemble"
+        controller = boppy.application.MainControllerCPU(self.raw_alg_input, self.raw_simul_input)
+        times_and_populations = controller.simulate()
+
+        self.assertEqual(self.raw_simul_input['Algorithm iterations'],
+                         len(times_and_populations))
+        for arr in times_and_populations:
+            self.assertEqual(arr.shape[1], 1 + len(self.raw_alg_input['Species']))
+            self.assertTrue(np.allclose(arr[0], [0, 80, 20, 0]))
+            self.assertGreaterEqual(arr[-1, 0], self.raw_simul_input['Maximum simulation time'])
+
+    def test_application_controller_simulation_tau_leaping(self):
+        self.raw_simul_input["Simulation"] = "tau-leaping"
+        controller = boppy.application.MainControllerCPU(self.raw_alg_input, self.raw_simul_input)
+        times_and_populations = controller.simulate()
+
+        self.assertEqual(self.raw_simul_input['Algorithm iterations'],
+                         len(times_and_populations))
+        for arr in times_and_populations:
+            self.assertTrue(np.all(arr[:, 1:] >= 0))
+            self.assertTrue(np.allclose(arr[:, 1:].sum(axis=1), 100))
+
+    def test_application_wrong_tau_leaping_epsilon(self):
+        with self.assertRaisesRegex(BoppyInputError, "The 'Tau-leaping epsilon' parameter has "
+                                                     "to be a number between 0 and 1."):
+            self.raw_simul_input["Simulation"] = "tau-leaping"
+            self.raw_simul_input["Tau-leaping epsilon"] = 2
+            boppy.application.MainControllerCPU(self.raw_alg_input, self.raw_simul_input)
+
+    def test_application_controller_simulation_chemical_langevin(self):
+        self.raw_simul_input["Simulation"] = "chemical langevin"
+        self.raw_simul_input["CLE time step"] = 0.5
+        self.raw_simul_input["CLE boundary"] = "reflect"
+        controller = boppy.application.MainControllerCPU(self.raw_alg_input, self.raw_simul_input)
+        times_and_populations = controller.simulate()
+
+        self.assertEqual(self.raw_simul_input['Algorithm iterations'],
+                         len(times_and_populations))
+        for arr in times_and_populations:
+            self.assertTrue(np.all(arr[:, 1:] >= 0))
+            self.assertAlmostEqual(arr[-1, 0], self.raw_simul_input['Maximum simulation time'])
+
+    def test_application_wrong_cle_boundary(self):
+        with self.assertRaisesRegex(BoppyInputError, "The 'CLE boundary' parameter must be one "
+                                                     "of .*\\."):
+            self.raw_simul_input["Simulation"] = "CLE"
+            self.raw_simul_input["CLE boundary"] = "absorb"
+            boppy.application.MainControllerCPU(self.raw_alg_input, self.raw_simul_input)
+
+    def test_application_controller_simulation_hybrid(self):
+        self.raw_simul_input["Simulation"] = "hybrid"
+        self.raw_simul_input["Fast reactions"] = ["x_s + x_i =>  x_i + x_i"]
+        controller = boppy.application.MainControllerCPU(self.raw_alg_input, self.raw_simul_input)
+        times_and_populations = controller.simulate()
+
+        self.assertEqual(self.raw_simul_input['Algorithm iterations'],
+                         len(times_and_populations))
+        for arr in times_and_populations:
+            self.assertTrue(np.all(arr[:, 1:] >= 0))
+            self.assertTrue(np.allclose(arr[:, 1:].sum(axis=1), 100))
+
+    def test_application_wrong_fast_reactions(self):
+        with self.assertRaisesRegex(BoppyInputError, "The reaction 'x_s => x_r' in 'Fast "
+                                                     "reactions' does not match any reaction "
+                                                     "provided."):
+            self.raw_simul_input["Simulation"] = "hybrid"
+            self.raw_simul_input["Fast reactions"] = ["x_s => x_r"]
+            boppy.application.MainControllerCPU(self.raw_alg_input, self.raw_simul_input)
+
+    def test_application_controller_simulation_slow_scale_ssa(self):
+        self.raw_simul_input["Simulation"] = "slow-scale SSA"
+        controller = boppy.application.MainControllerCPU(self.raw_alg_input, self.raw_simul_input)
+        times_and_populations = controller.simulate()
+
+        # The model has no reversible pairs, so it's simulated as the SSA.
+        self.assertEqual(self.raw_simul_input['Algorithm iterations'],
+                         len(times_and_populations))
+        for arr in times_and_populations:
+            self.assertTrue(np.allclose(arr[:, 1:].sum(axis=1), 100))
+            self.assertGreaterEqual(arr[-1, 0], self.raw_simul_input['Maximum simulation time'])
+
+    def test_application_controller_simulation_fluid_approximation(self):
+        self.raw_simul_input["Simulation"] = "mean field"
+        self.raw_simul_input["ODE solver"] = "BDF"
+        self.raw_simul_input["Algorithm iterations"] = 1
+        controller = boppy.application.MainControllerCPU(self.raw_alg_input, self.raw_simul_input)
+        times_and_populations = controller.simulate()
+
+        self.assertEqual(times_and_populations[0].shape, (1000, 4))
+        self.assertTrue(np.allclose(times_and_populations[0][:, 1:].sum(axis=1), 1))
+
+    def test_application_controller_simulation_parameter_sweep(self):
+        self.raw_simul_input["Simulation"] = "fluid approximation"
+        self.raw_simul_input["Parameter sweep"] = {"k_i": [0.5, 1, 2], "k_r": [0.1, 0.2, 0.3]}
+        self.raw_simul_input["Number of processes"] = 2
+        controller = boppy.application.MainControllerCPU(self.raw_alg_input, self.raw_simul_input)
+        times_and_populations = controller.simulate()
+
+        self.assertEqual(len(times_and_populations), 3)
+        self.assertTrue(np.array_equal(times_and_populations.lengths, [1000, 1000, 1000]))
+        self.assertTrue(np.allclose(times_and_populations.data[:, 1:].sum(axis=1), 1))
+        self.assertFalse(np.allclose(times_and_populations[0], times_and_populations[1]))
+
+    def test_application_wrong_parameter_sweep(self):
+        with self.assertRaisesRegex(BoppyInputError, "All the parameters in 'Parameter sweep' "
+                                                     "must have the same number of values."):
+            self.raw_simul_input["Simulation"] = "ODE"
+            self.raw_simul_input["Parameter sweep"] = {"k_i": [0.5, 1], "k_r": [0.1]}
+            boppy.application.MainControllerCPU(self.raw_alg_input, self.raw_simul_input)
+
+    def test_application_wrong_ode_solver(self):
+        with self.assertRaisesRegex(BoppyInputError, "The 'ODE solver' parameter must be one "
+                                                     "of .*\\."):
+            self.raw_simul_input["Simulation"] = "ODE"
+            self.raw_simul_input["ODE solver"] = "euler"
+            boppy.application.MainControllerCPU(self.raw_alg_input, self.raw_simul_input)
 
     def test_application_missing_iterations_param(self):
         del self.raw_simul_input["Algorithm iterations"]
@@ -284,8 +595,8 @@ class BoppyApplicationTest(unittest.TestCase):
 
         self.assertEqual(controller._iterations, 1)
         self.assertTrue(np.allclose(times_and_populations[0][-2:],
-                                    np.array([99.438658085172847, 13, 10, 77,
-                                              100.21927360825548, 14, 10, 76]).reshape(2, 4)))
+                                    np.array([99.89834638240643, 6, 13, 81,
+                                              100.31781549974565, 7, 13, 80]).reshape(2, 4)))
 
     def test_application_controller_simulation_1_iteration(self):
         self.raw_simul_input['Algorithm iterations'] = 1
@@ -300,8 +611,8 @@ class BoppyApplicationTest(unittest.TestCase):
             self.assertEqual(arr.shape[1], 1 + len(self.raw_alg_input['Species']))
 
         self.assertTrue(np.allclose(times_and_populations[0][-2:],
-                                    np.array([99.438658085172847, 13, 10, 77,
-                                              100.21927360825548, 14, 10, 76]).reshape(2, 4)))
+                                    np.array([99.89834638240643, 6, 13, 81,
+                                              100.31781549974565, 7, 13, 80]).reshape(2, 4)))
 
     def test_application_controller_simulation_1_process(self):
         self.raw_simul_input['Algorithm iterations'] = 1  # To speed up tests.
@@ -310,8 +621,8 @@ class BoppyApplicationTest(unittest.TestCase):
         times_and_populations = controller.simulate()
 
         self.assertTrue(np.allclose(times_and_populations[0][-2:],
-                                    np.array([99.438658085172847, 13, 10, 77,
-                                              100.21927360825548, 14, 10, 76]).reshape(2, 4)))
+                                    np.array([99.89834638240643, 6, 13, 81,
+                                              100.31781549974565, 7, 13, 80]).reshape(2, 4)))
 
     def test_application_controller_simulation_missing_num_processes(self):
         self.raw_simul_input['Algorithm iterations'] = 1
@@ -321,8 +632,8 @@ class BoppyApplicationTest(unittest.TestCase):
 
         self.assertEqual(controller._nproc, self.num_procs)
         self.assertTrue(np.allclose(times_and_populations[0][-2:],
-                                    np.array([99.438658085172847, 13, 10, 77,
-                                              100.21927360825548, 14, 10, 76]).reshape(2, 4)))
+                                    np.array([99.89834638240643, 6, 13, 81,
+                                              100.31781549974565, 7, 13, 80]).reshape(2, 4)))
 
     def test_application_controller_simulation_zero_num_processes(self):
         self.raw_simul_input['Algorithm iterations'] = 1
@@ -332,8 +643,8 @@ class BoppyApplicationTest(unittest.TestCase):
 
         self.assertEqual(controller._nproc, self.num_procs)
         self.assertTrue(np.allclose(times_and_populations[0][-2:],
-                                    np.array([99.438658085172847, 13, 10, 77,
-                                              100.21927360825548, 14, 10, 76]).reshape(2, 4)))
+                                    np.array([99.89834638240643, 6, 13, 81,
+                                              100.31781549974565, 7, 13, 80]).reshape(2, 4)))
 
     def test_application_controller_simulation_negative_num_processes(self):
         self.raw_simul_input['Algorithm iterations'] = 1
@@ -343,8 +654,8 @@ class BoppyApplicationTest(unittest.TestCase):
 
         self.assertEqual(controller._nproc, self.num_procs)
         self.assertTrue(np.allclose(times_and_populations[0][-2:],
-                                    np.array([99.438658085172847, 13, 10, 77,
-                                              100.21927360825548, 14, 10, 76]).reshape(2, 4)))
+                                    np.array([99.89834638240643, 6, 13, 81,
+                                              100.31781549974565, 7, 13, 80]).reshape(2, 4)))
 
     def tearDown(self):
         np.random.seed()